@@ -0,0 +1,72 @@
+import time
+import random
+import pandas as pd
+from data_processor import (
+    ComparadorPatrones, PATRONES_PERSONALIZADOS, PATRONES_EXACTOS, CATEGORIAS_TODAS, limpiar_texto_cierre
+)
+
+# Benchmark del comparador compilado de PATRONES_PERSONALIZADOS contra el recorrido
+# original (for + 'in' en orden de prioridad). Verifica que ambos den lo mismo y
+# mide cómo escala cada uno al agregar reglas (para ajustar UMBRAL_REGLAS_COMPILADAS).
+# Uso: python benchmark_patrones.py
+
+N_TEXTOS = 50000
+TAMANIOS_REGLAS = [len(PATRONES_PERSONALIZADOS), 30, 50, 100, 500]
+
+def primer_patron_lineal(texto, patrones):
+    """Versión original: primer patrón (en orden) contenido en el texto."""
+    for patron, categoria in patrones.items():
+        if patron in texto: return categoria
+    return None
+
+def generar_textos(n, semilla=0):
+    """Textos tipo texto_limpio: categorías/cierres reales con ruido y palabras sueltas."""
+    rnd = random.Random(semilla)
+    base = CATEGORIAS_TODAS + list(PATRONES_EXACTOS) + list(PATRONES_PERSONALIZADOS)
+    palabras = ' '.join(base).split()
+    textos = []
+    for _ in range(n):
+        partes = rnd.sample(palabras, rnd.randint(1, 8))
+        if rnd.random() < 0.5:
+            partes.insert(rnd.randint(0, len(partes)), rnd.choice(base))
+        textos.append(limpiar_texto_cierre(' '.join(partes)))
+    return textos
+
+def generar_reglas(n, semilla=0):
+    """Las reglas reales primero y después reglas sintéticas (frases de 2-3 palabras)."""
+    rnd = random.Random(semilla)
+    palabras = ' '.join(CATEGORIAS_TODAS + list(PATRONES_EXACTOS)).split()
+    reglas = dict(PATRONES_PERSONALIZADOS)
+    while len(reglas) < n:
+        reglas[' '.join(rnd.sample(palabras, rnd.randint(2, 3)))] = rnd.choice(CATEGORIAS_TODAS)
+    return reglas
+
+def medir(textos, reglas):
+    comparador = ComparadorPatrones(reglas, compilar=True)
+
+    t = time.perf_counter()
+    esperado = [primer_patron_lineal(x, reglas) for x in textos]
+    t_lineal = time.perf_counter() - t
+
+    t = time.perf_counter()
+    obtenido = comparador.categorizar(pd.Series(textos)).tolist()
+    t_compilado = time.perf_counter() - t
+
+    diferencias = sum(a != b for a, b in zip(esperado, obtenido))
+    return t_lineal, t_compilado, diferencias
+
+def main():
+    textos = generar_textos(N_TEXTOS)
+    print(f"📊 {len(textos)} textos ({len(set(textos))} distintos)")
+    ok = True
+    for n in TAMANIOS_REGLAS:
+        t_lineal, t_compilado, diferencias = medir(textos, generar_reglas(n))
+        estado = "✅" if diferencias == 0 else "❌"
+        ok = ok and diferencias == 0
+        usa = "compilado" if ComparadorPatrones(generar_reglas(n)).compilado else "lineal"
+        print(f"{estado} {n:>4} reglas: lineal {t_lineal:.2f}s | compilado {t_compilado:.2f}s "
+              f"(x{t_lineal / t_compilado:.1f}) | diferencias: {diferencias} | en producción usa: {usa}")
+    print("\n✅ Equivalente en todos los casos." if ok else "\n❌ Hay diferencias con el recorrido original.")
+
+if __name__ == "__main__":
+    main()
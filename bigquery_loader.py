@@ -0,0 +1,243 @@
+import os
+import tempfile
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from google.api_core.exceptions import NotFound
+from google.cloud import bigquery
+
+# ==========================================
+# CARGA INCREMENTAL A BIGQUERY (PARTICIONADA POR SEMANA)
+# ==========================================
+# La tabla historico_limpio queda particionada por Semana_Inicio (lunes de la semana
+# W-SUN de 'Fecha Inicio', una partición diaria por semana) y clusterizada por
+# codigo_zona. Cada corrida sube a una tabla staging solo las semanas afectadas
+# y un MERGE reemplaza esas particiones en la tabla final.
+# Nunca se borra la tabla final antes de cargar: la carga completa también pasa por
+# staging y recién al final un CREATE OR REPLACE la reemplaza en un solo paso.
+# Los errores se propagan (la corrida falla y el manifiesto de main.py no avanza).
+# Todas las funciones reciben el client para poder probarlas con un cliente falso.
+
+COLUMNA_PARTICION = 'Semana_Inicio'
+# BigQuery no clusteriza por FLOAT64: comuna_calculada (1-15, 2.5, 14.5) se codifica
+# como entero x10 (10..150, 25 = 2.5, 145 = 14.5; NULL = sin zona)
+COLUMNA_ZONA = 'codigo_zona'
+COLUMNAS_CLUSTER = [COLUMNA_ZONA]
+SUFIJO_STAGING = '_staging'
+SUFIJO_STAGING_COMPLETO = '_staging_completo'
+
+# ==========================================
+# ESQUEMA FIJO DE historico_limpio
+# ==========================================
+# Cualquier cambio de columnas/tipos de la tabla se hace acá (versionado con el código).
+# Cada columna del limpio tiene que figurar con su tipo real: una columna no declarada
+# (ej. una columna nueva del Excel) hace fallar la carga en vez de subirse como STRING,
+# y staging y tabla final siempre tienen el mismo orden para el MERGE.
+# Modos de carga:
+#   'parquet'   -> escribe el DataFrame a parquet una vez y lo sube con load_table_from_file
+#                  usando este esquema (default).
+#   'dataframe' -> load_table_from_dataframe, el cliente infiere el esquema de los dtypes.
+MODO_CARGA = os.getenv('BAP_BQ_MODO_CARGA', 'parquet')
+
+ESQUEMA_HISTORICO = [
+    # DATETIME (hora local de Buenos Aires, sin zona): el mismo tipo que to_gbq y
+    # load_table_from_dataframe infieren para un datetime64 naive
+    ('Fecha Inicio', 'DATETIME'),
+    ('Fecha Fin', 'DATETIME'),
+    ('Recurso Fecha Liberado', 'DATETIME'),
+    ('Recurso Fecha asignacion', 'DATETIME'),
+    ('Recurso Arribo', 'DATETIME'),
+    ('Latitud', 'FLOAT64'),
+    ('Longitud', 'FLOAT64'),
+    ('Persona DNI', 'STRING'),
+    ('Persona Nombre', 'STRING'),
+    ('Persona Apellido', 'STRING'),
+    ('Agencia', 'STRING'),
+    ('Cierre Supervisor', 'STRING'),
+    ('Resultado', 'STRING'),
+    ('Estado', 'STRING'),
+    ('Tipo Carta', 'STRING'),
+    ('Observaciones', 'STRING'),
+    ('id_fila', 'INT64'),
+    ('hash_contenido', 'INT64'),
+    ('comuna_calculada', 'FLOAT64'),
+    ('DNI_Categorizado', 'STRING'),
+    ('DNI_Categorizado_motivo', 'STRING'),
+    ('dni', 'INT64'),
+    ('dni_estado', 'STRING'),
+    ('cierre_texto', 'STRING'),
+    ('texto_limpio', 'STRING'),
+    ('categoria_final', 'STRING'),
+    ('contacto', 'STRING'),
+    ('brinda_datos', 'STRING'),
+    ('Tipo_Evolucion', 'STRING'),
+    (COLUMNA_ZONA, 'INT64'),
+    (COLUMNA_PARTICION, 'DATE'),
+]
+
+TIPOS_ARROW = {
+    'DATETIME': pa.timestamp('us'),
+    'DATE': pa.date32(),
+    'FLOAT64': pa.float64(),
+    'INT64': pa.int64(),
+    'STRING': pa.string(),
+}
+
+def esquema_para(df):
+    """
+    Lista (columna, tipo BigQuery) para las columnas de df, en el orden fijo del esquema.
+    Lanza ValueError si df tiene columnas que no están en ESQUEMA_HISTORICO.
+    """
+    tipos = dict(ESQUEMA_HISTORICO)
+    no_declaradas = sorted(c for c in df.columns if c not in tipos)
+    if no_declaradas:
+        raise ValueError(f"Columnas sin tipo en bigquery_loader.ESQUEMA_HISTORICO: {no_declaradas}. "
+                         "Declararlas (y en esquema_limpio.ESQUEMA_LIMPIO) antes de subir.")
+    return [(c, t) for c, t in ESQUEMA_HISTORICO if c in df.columns]
+
+def _columna_arrow(serie, tipo):
+    """Convierte una columna al tipo del esquema (los mixtos object se castean, no se infieren)."""
+    if tipo == 'DATETIME':
+        serie = pd.to_datetime(serie)
+        if serie.dt.tz is not None:
+            serie = serie.dt.tz_localize(None)
+    elif tipo == 'FLOAT64':
+        serie = pd.to_numeric(serie, errors='coerce').astype('float64')
+    elif tipo == 'INT64':
+        serie = pd.to_numeric(serie, errors='coerce').astype('Int64')
+    elif tipo == 'STRING':
+        serie = serie.astype('string')
+    return pa.array(serie, type=TIPOS_ARROW[tipo], from_pandas=True)
+
+def tabla_arrow(df, esquema):
+    return pa.table({c: _columna_arrow(df[c], t) for c, t in esquema})
+
+def _job_config(write_disposition, esquema=None):
+    config = bigquery.LoadJobConfig(
+        write_disposition=write_disposition,
+        time_partitioning=bigquery.TimePartitioning(
+            type_=bigquery.TimePartitioningType.DAY, field=COLUMNA_PARTICION
+        ),
+        clustering_fields=COLUMNAS_CLUSTER,
+    )
+    if esquema is not None:
+        config.source_format = bigquery.SourceFormat.PARQUET
+        config.schema = [bigquery.SchemaField(c, t) for c, t in esquema]
+    return config
+
+def subir(client, df, table_ref, write_disposition, modo=None):
+    """Ejecuta un job de carga según el modo ('parquet' con esquema fijo o 'dataframe')."""
+    modo = modo or MODO_CARGA
+    esquema = esquema_para(df)
+    if modo == 'dataframe':
+        # El cliente no infiere un tipo BigQuery para columnas category: se suben como texto
+        categoricas = df.select_dtypes('category').columns
+        df = df.astype({c: 'str' for c in categoricas})
+        client.load_table_from_dataframe(df, table_ref, job_config=_job_config(write_disposition)).result()
+        return
+    if modo != 'parquet':
+        raise ValueError(f"Modo de carga desconocido: {modo}")
+
+    fd, ruta = tempfile.mkstemp(suffix='.parquet')
+    os.close(fd)
+    try:
+        pq.write_table(tabla_arrow(df, esquema), ruta)
+        with open(ruta, 'rb') as fh:
+            client.load_table_from_file(fh, table_ref, job_config=_job_config(write_disposition, esquema)).result()
+    finally:
+        os.remove(ruta)
+
+def agregar_columnas_tabla(df, col_fecha='Fecha Inicio', col_comuna='comuna_calculada'):
+    """Agrega Semana_Inicio (DATE) y codigo_zona (INT64) sin modificar el DataFrame original."""
+    df = df.copy()
+    df[COLUMNA_PARTICION] = df[col_fecha].dt.to_period('W-SUN').dt.start_time.dt.date
+    df[COLUMNA_ZONA] = (pd.to_numeric(df[col_comuna], errors='coerce') * 10).round().astype('Int64')
+    return df
+
+def _tabla_particionada(client, table_ref):
+    """True si la tabla existe y ya está particionada por Semana_Inicio y clusterizada por codigo_zona."""
+    # Solo "no existe" cuenta como no particionada: cualquier otro error (red, permisos)
+    # se propaga
+    try:
+        tabla = client.get_table(table_ref)
+    except NotFound:
+        return False
+    particion = getattr(tabla, 'time_partitioning', None)
+    cluster = list(getattr(tabla, 'clustering_fields', None) or [])
+    return particion is not None and particion.field == COLUMNA_PARTICION and cluster == COLUMNAS_CLUSTER
+
+def sql_reemplazar_tabla(table_ref, staging_ref):
+    """CREATE OR REPLACE de la tabla final desde staging, con su partición y cluster."""
+    return f"""
+    CREATE OR REPLACE TABLE `{table_ref}`
+    PARTITION BY {COLUMNA_PARTICION}
+    CLUSTER BY {', '.join(COLUMNAS_CLUSTER)}
+    AS SELECT * FROM `{staging_ref}`
+    """
+
+def cargar_completo(client, df, table_ref, modo=None):
+    """
+    Reemplaza la tabla entera (crea la partición/cluster si todavía no existían).
+    Carga todo en una tabla staging y solo si esa carga terminó bien la copia a la final
+    con CREATE OR REPLACE: si algo falla la tabla productiva queda como estaba.
+    """
+    staging_ref = f"{table_ref}{SUFIJO_STAGING_COMPLETO}"
+    print(f"⬆️ Carga completa a {table_ref} ({len(df)} filas, vía {staging_ref})...")
+    # Un staging que quedó de una corrida cortada puede tener otro esquema
+    client.delete_table(staging_ref, not_found_ok=True)
+    try:
+        subir(client, df, staging_ref, 'WRITE_TRUNCATE', modo)
+        client.query(sql_reemplazar_tabla(table_ref, staging_ref)).result()
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+
+def sql_merge_semanas(table_ref, staging_ref, semana_desde):
+    """
+    MERGE que reemplaza las particiones >= semana_desde (y la de Semana_Inicio NULL, filas
+    sin Fecha Inicio) por el contenido de staging.
+    ON FALSE: nada "matchea", así que se borra todo lo que había en esas semanas
+    (incluye filas que el dedup semanal ahora descarta) y se insertan las nuevas.
+    """
+    return f"""
+    MERGE `{table_ref}` T
+    USING `{staging_ref}` S
+    ON FALSE
+    WHEN NOT MATCHED BY SOURCE AND (T.{COLUMNA_PARTICION} >= DATE '{semana_desde.isoformat()}'
+                                    OR T.{COLUMNA_PARTICION} IS NULL) THEN DELETE
+    WHEN NOT MATCHED THEN INSERT ROW
+    """
+
+def cargar_incremental(client, df, table_ref, semana_desde, modo=None):
+    """
+    Sube solo las semanas >= semana_desde (más las filas sin fecha) a staging y las mergea
+    en la tabla final.
+    Si la tabla no existe, no está particionada o el MERGE falla (ej. cambió el esquema)
+    se hace una carga completa.
+    """
+    if not _tabla_particionada(client, table_ref):
+        print("⚠️ La tabla no existe o no está particionada: se hace carga completa.")
+        return cargar_completo(client, df, table_ref, modo)
+
+    # Las filas sin fecha (partición NULL) no tienen semana: van siempre en el delta
+    particion = df[COLUMNA_PARTICION]
+    df_delta = df[particion.isna() | (particion >= semana_desde)]
+    staging_ref = f"{table_ref}{SUFIJO_STAGING}"
+    print(f"⬆️ Carga incremental a {table_ref}: {len(df_delta)} filas desde la semana {semana_desde} (de {len(df)}).")
+
+    client.delete_table(staging_ref, not_found_ok=True)
+    subir(client, df_delta, staging_ref, 'WRITE_TRUNCATE', modo)
+    try:
+        client.query(sql_merge_semanas(table_ref, staging_ref, semana_desde)).result()
+    except Exception as e:
+        print(f"⚠️ MERGE falló ({e}). Se hace carga completa.")
+        cargar_completo(client, df, table_ref, modo)
+    finally:
+        client.delete_table(staging_ref, not_found_ok=True)
+
+def cargar_historico(client, df, table_ref, semana_desde=None, modo=None):
+    """Punto de entrada: semana_desde=None => carga completa; si no, incremental."""
+    df = agregar_columnas_tabla(df)
+    if semana_desde is None:
+        cargar_completo(client, df, table_ref, modo)
+    else:
+        cargar_incremental(client, df, table_ref, pd.Timestamp(semana_desde).date(), modo)
@@ -0,0 +1,476 @@
+import os
+import hashlib
+from concurrent.futures import ProcessPoolExecutor
+import zipfile
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# ==========================================
+# CLASIFICADOR DE ZONAS (FASE 2)
+# ==========================================
+# Reemplaza los tres gpd.sjoin secuenciales (Palermo Norte, Anillo Digital C2, comunas.shp)
+# por un único índice espacial (STRtree) con los polígonos de las tres capas.
+# Cada punto se consulta una sola vez con predicate='within' (misma semántica que el
+# sjoin) y, si cae en varias capas, gana la de mayor prioridad.
+#
+# Prioridad: en el flujo original el PASO 2 (Anillo) pisaba lo asignado en el PASO 1
+# (Palermo) sin chequear, y el PASO 3 (comunas) solo completaba los puntos sin zona.
+# La precedencia efectiva es entonces 2.5 > 14.5 > comuna (hoy Palermo Norte y el
+# Anillo no se superponen, así que el orden entre ambos no cambia ningún resultado).
+
+DIRECTORIO_ZONAS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'assets', 'comunas')
+CRS_PUNTOS = "EPSG:4326"
+
+CODIGO_PALERMO_NORTE = 14.5
+CODIGO_ANILLO_C2 = 2.5
+
+# (capa, archivo, código, prioridad, obligatoria). Menor prioridad = gana.
+CAPAS_ESPECIALES = [
+    ('anillo_digital_c2', 'anillo_digital_c2.kmz', CODIGO_ANILLO_C2, 0, False),
+    ('palermo_norte', 'Palermo_Norte.kmz', CODIGO_PALERMO_NORTE, 1, True),
+]
+ARCHIVO_COMUNAS = 'comunas.shp'
+PRIORIDAD_COMUNAS = 2
+
+# Artefacto compilado: todas las capas ya en EPSG:4326, geometrías en WKB, con el
+# checksum de los archivos fuente en la metadata. Si algún fuente cambia se recompila solo.
+ARCHIVO_COMPILADO = 'zonas_compiladas.parquet'
+VERSION_COMPILADO = '1'
+EXTENSIONES_SHP = ['.shp', '.shx', '.dbf', '.prj', '.cpg']
+
+def _leer_kmz(ruta):
+    """Lee el primer KML dentro de un KMZ."""
+    # fiona solo se importa al compilar: el camino normal lee el artefacto compilado
+    import fiona
+
+    # Habilitar soporte KML en fiona
+    fiona.drvsupport.supported_drivers['KML'] = 'rw'
+    fiona.drvsupport.supported_drivers['LIBKML'] = 'rw'
+    with zipfile.ZipFile(ruta, 'r') as kmz:
+        kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
+        if not kml_files:
+            raise FileNotFoundError(f"❌ No se encontró archivo KML dentro del KMZ: {ruta}")
+        with kmz.open(kml_files[0]) as kml_file:
+            return gpd.read_file(kml_file)
+
+def _a_crs_puntos(gdf):
+    # Asegurar mismo CRS que los puntos
+    if gdf.crs != CRS_PUNTOS:
+        gdf = gdf.to_crs(CRS_PUNTOS)
+    return gdf
+
+def leer_capas(directorio=DIRECTORIO_ZONAS):
+    """
+    Lee las capas de zonas desde los archivos fuente y las devuelve en un único
+    GeoDataFrame [capa, codigo, prioridad, geometry] en EPSG:4326.
+    """
+    capas = []
+    for capa, archivo, codigo, prioridad, obligatoria in CAPAS_ESPECIALES:
+        ruta = os.path.join(directorio, archivo)
+        if not os.path.exists(ruta):
+            if obligatoria:
+                raise FileNotFoundError(f"❌ No encuentro el archivo KMZ en: {ruta}")
+            print(f"⚠️ Archivo {ruta} no encontrado - se omite {capa}")
+            continue
+        gdf = _a_crs_puntos(_leer_kmz(ruta))
+        capas.append(gpd.GeoDataFrame({
+            'capa': capa, 'codigo': codigo, 'prioridad': prioridad, 'geometry': gdf.geometry.values
+        }, crs=CRS_PUNTOS))
+
+    ruta_shp = os.path.join(directorio, ARCHIVO_COMUNAS)
+    if not os.path.exists(ruta_shp):
+        raise FileNotFoundError(f"❌ No encuentro el shapefile en: {ruta_shp}")
+    gdf_comunas = _a_crs_puntos(gpd.read_file(ruta_shp))
+    capas.append(gpd.GeoDataFrame({
+        'capa': 'comunas',
+        'codigo': gdf_comunas['comuna'].astype('float64').values,
+        'prioridad': PRIORIDAD_COMUNAS,
+        'geometry': gdf_comunas.geometry.values,
+    }, crs=CRS_PUNTOS))
+
+    return pd.concat(capas, ignore_index=True)
+
+# ==========================================
+# ARTEFACTO COMPILADO
+# ==========================================
+
+def archivos_fuente(directorio=DIRECTORIO_ZONAS):
+    """Archivos de los que depende la clasificación (los que existan)."""
+    base = os.path.splitext(ARCHIVO_COMUNAS)[0]
+    nombres = [archivo for _, archivo, _, _, _ in CAPAS_ESPECIALES] + [base + ext for ext in EXTENSIONES_SHP]
+    return [os.path.join(directorio, n) for n in nombres if os.path.exists(os.path.join(directorio, n))]
+
+def checksum_fuentes(directorio=DIRECTORIO_ZONAS):
+    """sha256 de nombre + contenido de cada archivo fuente (cambia si se edita/agrega/quita una capa)."""
+    h = hashlib.sha256(VERSION_COMPILADO.encode())
+    for ruta in archivos_fuente(directorio):
+        h.update(os.path.basename(ruta).encode())
+        with open(ruta, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+def compilar_zonas(directorio=DIRECTORIO_ZONAS, destino=None, checksum=None):
+    """Lee las capas fuente (KMZ + SHP) y escribe el artefacto compilado. Devuelve las capas."""
+    destino = destino or os.path.join(directorio, ARCHIVO_COMPILADO)
+    checksum = checksum or checksum_fuentes(directorio)
+    capas = leer_capas(directorio)
+
+    tabla = pa.table({
+        'capa': pa.array(capas['capa'].astype(str).tolist(), type=pa.string()),
+        'codigo': pa.array(capas['codigo'].to_numpy(dtype='float64')),
+        'prioridad': pa.array(capas['prioridad'].to_numpy(dtype='int64')),
+        'geometry': pa.array(shapely.to_wkb(capas.geometry.values), type=pa.binary()),
+    }).replace_schema_metadata({'checksum_fuentes': checksum, 'crs': CRS_PUNTOS})
+    try:
+        pq.write_table(tabla, destino)
+        print(f"🧩 Zonas compiladas en {destino} ({len(capas)} polígonos).")
+    except OSError as e:
+        # ej. filesystem de solo lectura: se sigue con las capas en memoria
+        print(f"⚠️ No se pudo guardar {destino} ({e}). Se usan las capas en memoria.")
+    return capas
+
+def capas_desde_wkb(capa, codigo, prioridad, geometrias_wkb):
+    """GeoDataFrame de capas [capa, codigo, prioridad, geometry] a partir de columnas con WKB."""
+    return gpd.GeoDataFrame({
+        'capa': capa,
+        'codigo': codigo,
+        'prioridad': prioridad,
+        'geometry': shapely.from_wkb(geometrias_wkb),
+    }, crs=CRS_PUNTOS)
+
+def cargar_capas(directorio=DIRECTORIO_ZONAS):
+    """
+    Devuelve (capas, checksum). Lee el artefacto compilado si está al día con los
+    archivos fuente; si falta o quedó viejo lo recompila.
+    """
+    checksum = checksum_fuentes(directorio)
+    ruta = os.path.join(directorio, ARCHIVO_COMPILADO)
+    if os.path.exists(ruta):
+        metadata = pq.read_schema(ruta).metadata or {}
+        if metadata.get(b'checksum_fuentes', b'').decode() == checksum:
+            tabla = pq.read_table(ruta)
+            capas = capas_desde_wkb(
+                tabla['capa'].to_pylist(), tabla['codigo'].to_numpy(), tabla['prioridad'].to_numpy(),
+                tabla['geometry'].to_numpy(zero_copy_only=False),
+            )
+            return capas, checksum
+        print("🔁 Los archivos de zonas cambiaron: se recompila el artefacto.")
+    return compilar_zonas(directorio, ruta, checksum), checksum
+
+# ==========================================
+# CLASIFICADOR
+# ==========================================
+
+class ClasificadorZonas:
+    """Asigna comuna_calculada (1-15, 2.5, 14.5) a coordenadas con un solo índice espacial."""
+
+    def __init__(self, capas, checksum=None):
+        self.capas = capas.reset_index(drop=True)
+        self.checksum = checksum  # checksum de los archivos fuente (versiona resultados derivados)
+        self.codigos = self.capas['codigo'].to_numpy(dtype='float64')
+        self.prioridades = self.capas['prioridad'].to_numpy()
+        self.bbox = self.capas.total_bounds  # minx, miny, maxx, maxy (toda CABA)
+        self.geometrias = np.asarray(self.capas.geometry.values)
+        shapely.prepare(self.geometrias)
+        self.arbol = shapely.STRtree(self.geometrias)
+        self.grilla = None
+
+    @classmethod
+    def desde_assets(cls, directorio=DIRECTORIO_ZONAS):
+        """Clasificador a partir del artefacto compilado (recompilado si hace falta)."""
+        return cls(*cargar_capas(directorio))
+
+    def _en_bbox(self, lon, lat):
+        minx, miny, maxx, maxy = self.bbox
+        # Las comparaciones con NaN dan False: las coordenadas faltantes quedan afuera
+        return (lon >= minx) & (lon <= maxx) & (lat >= miny) & (lat <= maxy)
+
+    def _resolver_prioridad(self, idx_elemento, idx_poligono, n):
+        """
+        Pares (elemento, polígono) -> código de zona por elemento (NaN sin match).
+        Un elemento puede caer en más de una capa: se ordena por (elemento, prioridad) y
+        queda el primer match. Si cae en dos polígonos de la misma capa (slivers entre
+        comunas vecinas) gana el primero del archivo; el sjoin original duplicaba la fila
+        y fallaba al asignar.
+        """
+        resultado = np.full(n, np.nan)
+        if len(idx_elemento) == 0:
+            return resultado
+        orden = np.lexsort((idx_poligono, self.prioridades[idx_poligono], idx_elemento))
+        idx_elemento, idx_poligono = idx_elemento[orden], idx_poligono[orden]
+        primero = np.r_[True, idx_elemento[1:] != idx_elemento[:-1]]
+        resultado[idx_elemento[primero]] = self.codigos[idx_poligono[primero]]
+        return resultado
+
+    def clasificar_exacto(self, lon, lat):
+        """
+        lon, lat: arrays de coordenadas. Devuelve un array float64 con el código de zona
+        de cada punto (NaN si no cae dentro de ninguna).
+        """
+        lon = np.asarray(lon, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        resultado = np.full(len(lon), np.nan)
+
+        # Prefiltro por bounding box: fuera de CABA no hay nada que consultar
+        idx_candidatos = np.flatnonzero(self._en_bbox(lon, lat))
+        if len(idx_candidatos) == 0:
+            return resultado
+
+        puntos = shapely.points(lon[idx_candidatos], lat[idx_candidatos])
+        # Candidatos por bbox y luego el predicado contra los polígonos preparados:
+        # para un punto, contains(polígono, punto) equivale a within(punto, polígono)
+        idx_punto, idx_poligono = self.arbol.query(puntos)
+        adentro = shapely.contains(self.geometrias[idx_poligono], puntos[idx_punto])
+        idx_punto, idx_poligono = idx_punto[adentro], idx_poligono[adentro]
+        resultado[idx_candidatos] = self._resolver_prioridad(idx_punto, idx_poligono, len(idx_candidatos))
+        return resultado
+
+    def clasificar(self, lon, lat):
+        """Usa la grilla si está activada; si no, el test exacto punto en polígono."""
+        if self.grilla is not None:
+            return self.grilla.clasificar(lon, lat)
+        return self.clasificar_exacto(lon, lat)
+
+    def activar_grilla(self, celda=None, puntos_validacion=None):
+        """
+        Construye la grilla y la valida contra clasificar_exacto. Si la validación
+        encuentra alguna diferencia la grilla se descarta y se sigue con el test exacto.
+        """
+        grilla = GrillaZonas(self, celda)
+        diferencias = grilla.validar(puntos_validacion)
+        if diferencias:
+            print(f"⚠️ La grilla de zonas difiere del test exacto en {diferencias} puntos: se desactiva.")
+            return False
+        self.grilla = grilla
+        return True
+
+# ==========================================
+# GRILLA RASTERIZADA (OPCIONAL, PARA BACKFILLS GRANDES)
+# ==========================================
+# Grilla regular sobre el bbox de CABA. Una celda "pura" (cada polígono la contiene
+# estrictamente o no la toca) tiene un único resultado posible para cualquier punto
+# de adentro, así que se resuelve con indexado de NumPy. Solo los puntos de celdas de
+# borde pasan por el test exacto. Las celdas se evalúan agrandadas en un margen mínimo
+# para que el redondeo al calcular el índice de celda no pueda cambiar el resultado.
+
+USAR_GRILLA = os.getenv('BAP_GRILLA_ZONAS', '0') == '1'
+CELDA_GRILLA = float(os.getenv('BAP_GRILLA_CELDA', 0.0005))  # grados (~50 m)
+PUNTOS_VALIDACION_GRILLA = 20000
+
+class GrillaZonas:
+
+    def __init__(self, clasificador, celda=None):
+        self.clasificador = clasificador
+        self.celda = celda or CELDA_GRILLA
+        minx, miny, maxx, maxy = clasificador.bbox
+        self.origen = (minx, miny)
+        self.nx = max(int(np.ceil((maxx - minx) / self.celda)), 1)
+        self.ny = max(int(np.ceil((maxy - miny) / self.celda)), 1)
+
+        ix, iy = np.meshgrid(np.arange(self.nx), np.arange(self.ny))
+        ix, iy = ix.ravel(), iy.ravel()
+        margen = self.celda * 1e-6
+        cajas = shapely.box(
+            minx + ix * self.celda - margen, miny + iy * self.celda - margen,
+            minx + (ix + 1) * self.celda + margen, miny + (iy + 1) * self.celda + margen,
+        )
+
+        # Polígonos que tocan cada celda y, de esos, cuáles la contienen estrictamente.
+        # El árbol solo filtra por bbox: los predicados se evalúan con los polígonos
+        # preparados (mucho más rápido que query(predicate=...) sobre las cajas)
+        idx_celda, idx_poligono = clasificador.arbol.query(cajas)
+        geometrias = clasificador.geometrias
+        toca = shapely.intersects(geometrias[idx_poligono], cajas[idx_celda])
+        idx_celda, idx_poligono = idx_celda[toca], idx_poligono[toca]
+        contiene = shapely.contains_properly(geometrias[idx_poligono], cajas[idx_celda])
+
+        borde = np.zeros(len(cajas), dtype=bool)
+        borde[idx_celda[~contiene]] = True
+        codigos = clasificador._resolver_prioridad(idx_celda[contiene], idx_poligono[contiene], len(cajas))
+
+        self.borde = borde.reshape(self.ny, self.nx)
+        self.codigos = codigos.reshape(self.ny, self.nx)
+        print(f"🗺️ Grilla de zonas {self.nx}x{self.ny} (celda {self.celda}°): {borde.mean():.1%} celdas de borde.")
+
+    def clasificar(self, lon, lat):
+        lon = np.asarray(lon, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        resultado = np.full(len(lon), np.nan)
+        idx = np.flatnonzero(self.clasificador._en_bbox(lon, lat))
+        if len(idx) == 0:
+            return resultado
+
+        minx, miny = self.origen
+        ix = np.clip(((lon[idx] - minx) // self.celda).astype('int64'), 0, self.nx - 1)
+        iy = np.clip(((lat[idx] - miny) // self.celda).astype('int64'), 0, self.ny - 1)
+        resultado[idx] = self.codigos[iy, ix]
+
+        en_borde = self.borde[iy, ix]
+        if en_borde.any():
+            idx_borde = idx[en_borde]
+            resultado[idx_borde] = self.clasificador.clasificar_exacto(lon[idx_borde], lat[idx_borde])
+        return resultado
+
+    def validar(self, puntos=None):
+        """Cantidad de puntos donde la grilla y el test exacto difieren (0 = idénticos)."""
+        if puntos is None:
+            rng = np.random.default_rng(0)
+            minx, miny, maxx, maxy = self.clasificador.bbox
+            puntos = (rng.uniform(minx, maxx, PUNTOS_VALIDACION_GRILLA),
+                      rng.uniform(miny, maxy, PUNTOS_VALIDACION_GRILLA))
+        lon, lat = puntos
+        a = self.clasificar(lon, lat)
+        b = self.clasificador.clasificar_exacto(lon, lat)
+        return int((~((a == b) | (np.isnan(a) & np.isnan(b)))).sum())
+
+# ==========================================
+# MEMO DE COORDENADAS -> ZONA
+# ==========================================
+# Las intervenciones se repiten en las mismas direcciones: hay muchas menos coordenadas
+# distintas que filas. El memo guarda el código de zona por (lat, lon) cuantizadas a
+# DECIMALES_MEMO decimales (~1 mm, por debajo de la precisión de las coordenadas de origen)
+# y solo vale para el checksum de zonas con el que se calculó.
+
+DECIMALES_MEMO = 8
+COLUMNAS_MEMO = ['lat_q', 'lon_q', 'comuna_calculada']
+
+def cuantizar(valores):
+    return np.round(valores * 10 ** DECIMALES_MEMO).astype('int64')
+
+class MemoComunas:
+    """Lookup (lat_q, lon_q) -> código de zona; clasifica solo las coordenadas nunca vistas."""
+
+    def __init__(self, checksum, tabla=None):
+        self.checksum = checksum
+        if tabla is None:
+            tabla = pd.DataFrame({'lat_q': pd.Series(dtype='int64'), 'lon_q': pd.Series(dtype='int64'),
+                                  'comuna_calculada': pd.Series(dtype='float64')})
+        self.claves = pd.MultiIndex.from_arrays([tabla['lat_q'].to_numpy('int64'), tabla['lon_q'].to_numpy('int64')])
+        self.codigos = tabla['comuna_calculada'].to_numpy(dtype='float64')
+        self.nuevas = 0
+
+    def __len__(self):
+        return len(self.codigos)
+
+    def clasificar(self, clasificador, lon, lat):
+        """Igual que clasificador.clasificar(lon, lat), consultando el índice espacial solo para claves nuevas."""
+        lon = np.asarray(lon, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        resultado = np.full(len(lon), np.nan)
+        idx_validas = np.flatnonzero(np.isfinite(lon) & np.isfinite(lat))
+        if len(idx_validas) == 0:
+            return resultado
+
+        lon_v, lat_v = lon[idx_validas], lat[idx_validas]
+        lat_q, lon_q = cuantizar(lat_v), cuantizar(lon_v)
+        # Factorizar cada eje por separado y combinar los códigos es mucho más rápido
+        # que factorizar un MultiIndex; el MultiIndex se arma solo con las claves únicas
+        codigos_lat, _ = pd.factorize(lat_q)
+        codigos_lon, unicos_lon = pd.factorize(lon_q)
+        inversa, _ = pd.factorize(codigos_lat.astype('int64') * len(unicos_lon) + codigos_lon)
+        primera = np.unique(inversa, return_index=True)[1]
+        unicas = pd.MultiIndex.from_arrays([lat_q[primera], lon_q[primera]])
+        posiciones = self.claves.get_indexer(unicas)
+        codigos_unicos = np.full(len(unicas), np.nan)
+        conocidas = posiciones >= 0
+        codigos_unicos[conocidas] = self.codigos[posiciones[conocidas]]
+
+        faltantes = np.flatnonzero(posiciones < 0)
+        if len(faltantes):
+            # Se clasifica la primera coordenada real de cada clave nueva
+            codigos_unicos[faltantes] = clasificador.clasificar(lon_v[primera[faltantes]], lat_v[primera[faltantes]])
+            self.claves = self.claves.append(unicas[faltantes])
+            self.codigos = np.concatenate([self.codigos, codigos_unicos[faltantes]])
+            self.nuevas += len(faltantes)
+
+        print(f"🧠 Memo de coordenadas: {len(unicas)} coordenadas distintas, {len(faltantes)} nuevas al índice espacial.")
+        resultado[idx_validas] = codigos_unicos[inversa]
+        return resultado
+
+    def tabla(self):
+        return pd.DataFrame({
+            'lat_q': self.claves.get_level_values(0).to_numpy('int64'),
+            'lon_q': self.claves.get_level_values(1).to_numpy('int64'),
+            'comuna_calculada': self.codigos,
+            'checksum_zonas': self.checksum,
+        })
+
+# Se carga una sola vez por proceso, recién cuando Fase 2 lo necesita
+_CLASIFICADOR = None
+
+def obtener_clasificador():
+    global _CLASIFICADOR
+    if _CLASIFICADOR is None:
+        _CLASIFICADOR = ClasificadorZonas.desde_assets()
+        if USAR_GRILLA:
+            _CLASIFICADOR.activar_grilla()
+    return _CLASIFICADOR
+
+# ==========================================
+# CLASIFICACIÓN EN PARALELO (RECONSTRUCCIONES COMPLETAS)
+# ==========================================
+# Los puntos se parten en chunks contiguos que se clasifican en un ProcessPoolExecutor.
+# Cada worker reconstruye una sola vez el clasificador del proceso padre a partir de sus
+# capas (WKB), su checksum y el tamaño de celda de la grilla si está activa: no relee ni
+# recompila los assets. pool.map devuelve los chunks en orden, así que el resultado es
+# idéntico al camino serial.
+
+WORKERS_ZONAS = int(os.getenv('BAP_WORKERS_ZONAS', os.cpu_count() or 1))
+UMBRAL_PARALELO = 100000  # por debajo de esto no compensa levantar procesos
+CHUNKS_POR_WORKER = 4
+
+_CLASIFICADOR_WORKER = None
+
+def _estado_para_workers(clasificador):
+    """Argumentos de _inicializar_worker: todo lo necesario para rearmar el clasificador."""
+    capas = clasificador.capas
+    columnas = (
+        capas['capa'].astype(str).tolist(),
+        capas['codigo'].to_numpy(dtype='float64'),
+        capas['prioridad'].to_numpy(dtype='int64'),
+        shapely.to_wkb(capas.geometry.values),
+    )
+    celda = clasificador.grilla.celda if clasificador.grilla is not None else None
+    return columnas, clasificador.checksum, celda
+
+def _inicializar_worker(columnas, checksum, celda):
+    global _CLASIFICADOR_WORKER
+    clasificador = ClasificadorZonas(capas_desde_wkb(*columnas), checksum)
+    if celda is not None:
+        # Ya validada en el proceso padre: misma grilla, sin volver a validar
+        clasificador.grilla = GrillaZonas(clasificador, celda)
+    _CLASIFICADOR_WORKER = clasificador
+
+def _clasificar_chunk(coordenadas):
+    lon, lat = coordenadas
+    return _CLASIFICADOR_WORKER.clasificar(lon, lat)
+
+class ClasificadorParalelo:
+    """Misma interfaz que ClasificadorZonas.clasificar, repartiendo los puntos entre procesos."""
+
+    def __init__(self, clasificador, workers=None):
+        self.clasificador = clasificador
+        self.checksum = clasificador.checksum
+        self.workers = workers or WORKERS_ZONAS
+
+    def clasificar(self, lon, lat):
+        lon = np.asarray(lon, dtype='float64')
+        lat = np.asarray(lat, dtype='float64')
+        if self.workers <= 1 or len(lon) < UMBRAL_PARALELO:
+            return self.clasificador.clasificar(lon, lat)
+
+        n_chunks = self.workers * CHUNKS_POR_WORKER
+        cortes = np.linspace(0, len(lon), n_chunks + 1).astype('int64')
+        chunks = [(lon[a:b], lat[a:b]) for a, b in zip(cortes[:-1], cortes[1:])]
+        print(f"⚙️ Clasificando {len(lon)} puntos en {self.workers} procesos ({n_chunks} chunks)...")
+        with ProcessPoolExecutor(max_workers=self.workers, initializer=_inicializar_worker,
+                                 initargs=_estado_para_workers(self.clasificador)) as pool:
+            return np.concatenate(list(pool.map(_clasificar_chunk, chunks)))
+
+if __name__ == '__main__':
+    # Paso de build: python clasificador_zonas.py
+    compilar_zonas()
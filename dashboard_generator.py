@@ -4,138 +4,161 @@ import datetime
 import json
 import re
 import os
-from data_processor import get_drive_service, download_parquet_as_df
+from data_processor import get_drive_service, descargar_limpio, completar_dni, clave_dni, CACHE_DRIVE
 
 # --- CONFIGURACION ---
 # ID de la carpeta DB (tomado de main.py)
 FOLDER_ID_DB = '1q7rGJjb3qCTNcyDUYzpn9v4JveLjsk6t'
 FILE_NAME_PARQUET = '2025_historico_limpio.parquet'
 TEMPLATE_HTML_PATH = 'reporte_tablero.html'
+# Únicas columnas que usa el tablero: el resto del parquet no se materializa
+COLUMNAS_DASHBOARD = [
+    'Fecha Inicio', 'comuna_calculada', 'Estado', 'Resultado', 'Tipo Carta',
+    'DNI_Categorizado', 'dni', 'dni_estado', 'Persona DNI'
+]
 OUTPUT_HTML_PATH = 'reporte_autom_bap.html'
 
 # =============================================================================
 # LOGICA DE NEGOCIO
 # =============================================================================
 
-def clasificar_contacto(row):
-    """Clasificación estricta de contactos."""
-    no_contacta = [
-        '12–No se contacta y no se observan pertenencias',
-        '11-No se contacta y se observan pertenencias',
-        '16-Desestimado (cartas 911 u otras áreas)'
-    ]
-    
-    if row.get('Estado') == 'PENDIENTE':
-        # Excepcion pedida: Si es comuna 2 o 14, NO devolver 'Sin cubrir' automaticamente
-        c_val = row.get('comuna_calculada')
-        es_2_or_14 = False
-        try:
-            val = int(float(c_val))
-            if val in [2, 14]:
-                es_2_or_14 = True
-        except:
-            pass
-
-        if not es_2_or_14:
-            return 'Sin cubrir'
-    
-    resultado = row.get('Resultado')
-    if resultado in no_contacta:
-        return 'No se contacta'
-    elif resultado == '15-Sin cubrir':
-        return 'Sin cubrir'
-    else:
-        return 'Se contacta'
+# Resultados que cuentan como "No se contacta"
+NO_CONTACTA = [
+    '12–No se contacta y no se observan pertenencias',
+    '11-No se contacta y se observan pertenencias',
+    '16-Desestimado (cartas 911 u otras áreas)'
+]
+CATEGORIAS_CONTACTO = ['Se contacta', 'No se contacta', 'Sin cubrir']
 
-def calculate_dni_evolution(df_base, target_comuna_id=2):
+def clasificar_contactos(df):
     """
-    Calcula evolución de DNIs para una Comuna dada (Nuevos/Recurrentes/Migratorios).
-    target_comuna_id puede ser int (2, 14, etc).
+    Clasificación estricta de contactos, vectorizada sobre todas las filas de df:
+    PENDIENTE -> 'Sin cubrir' (salvo comunas 2 y 14, incluidas 2.5 y 14.5); si no,
+    Resultado en NO_CONTACTA -> 'No se contacta', '15-Sin cubrir' -> 'Sin cubrir',
+    el resto -> 'Se contacta'.
     """
-    COL_FECHA = "Fecha Inicio"
-    COL_DNI = "DNI_Categorizado"
-    COL_COMUNA = "comuna_calculada"
-    
-    df = df_base.copy()
-    if COL_DNI not in df.columns:
-        df[COL_DNI] = df['Persona DNI']
+    comuna = df['comuna_calculada']
+    if not pd.api.types.is_numeric_dtype(comuna):
+        comuna = pd.to_numeric(comuna, errors='coerce')
+    # Parte entera en [2, 14]: 2.5 (Anillo Digital) y 14.5 (Palermo Norte) también cuentan
+    es_2_or_14 = np.isin(np.trunc(comuna.to_numpy(dtype=float, na_value=np.nan)), [2, 14])
+    pendiente = (df['Estado'] == 'PENDIENTE').to_numpy(dtype=bool, na_value=False)
+    no_contacta = df['Resultado'].isin(NO_CONTACTA).to_numpy(dtype=bool, na_value=False)
+    sin_cubrir = (df['Resultado'] == '15-Sin cubrir').to_numpy(dtype=bool, na_value=False)
+    categoria = np.select(
+        [pendiente & ~es_2_or_14, no_contacta, sin_cubrir],
+        ['Sin cubrir', 'No se contacta', 'Sin cubrir'], default='Se contacta'
+    )
+    return pd.Series(categoria, index=df.index)
 
-    df = df.sort_values(COL_FECHA)
-    df["Semana"] = df[COL_FECHA].dt.to_period("W-SUN").apply(lambda r: r.start_time)
-    df_sem = df.drop_duplicates(subset=["Semana", COL_DNI]).copy()
+# Comunas y zonas especiales con evolución de DNI (una sola pasada para todas)
+ZONAS_EVOLUCION = [float(c) for c in range(1, 16)] + [2.5, 14.5]
 
-    def is_target_val(x):
-        if pd.isna(x): return False
-        if isinstance(x, (int, float)): return x == float(target_comuna_id)
-        
-        sx = str(x).upper().replace(" ", "")
-        
-        # Variaciones comunes
-        if target_comuna_id == 2:
-            return sx in {"2", "2.0", "COMUNA2"}
-        elif target_comuna_id == 14.5:
-            return sx in {"Palermo Norte"}
-        else:
-            # Fallback generico
-            return sx in {str(target_comuna_id), f"{target_comuna_id}.0", f"COMUNA{target_comuna_id}"}
-
-    semanas = sorted(df_sem["Semana"].unique())
-    dni_last_comuna = {}
-    dni_seen = set()
-    resultados = []
-
-    for semana in semanas:
-        rows_sem = df_sem[df_sem["Semana"] == semana]
-        rows_target = rows_sem[rows_sem[COL_COMUNA].apply(is_target_val)]
-        dnis_target = rows_target[COL_DNI].unique()
-
-        rec_count = 0
-        mig_count = 0
-        nue_count = 0
-
-        for dni in dnis_target:
-            prior_comuna = dni_last_comuna.get(dni, None)
-            if prior_comuna is None and dni not in dni_seen:
-                nue_count += 1
-            else:
-                # Si existia su ultima comuna registrada y ERA la target => Recurrente
-                if prior_comuna is not None and is_target_val(prior_comuna):
-                    rec_count += 1
-                else:
-                    # Si existia pero NO era la target => Migratorio (viene de otro lado)
-                    # O si no tenia prior_comuna pero YA FUE visto (caso borde) => Migratorio interno (??)
-                    # La logica original dice: "if prior_comuna is None and dni not in dni_seen: Nuevo"
-                    # "else: ..." -> aqui entra si tiene prior_comuna OR dni in dni_seen.
-                    mig_count += 1
-        
-        resultados.append({
-            "Semana": semana,
-            "recurrentes": int(rec_count),
-            "migratorios": int(mig_count),
-            "nuevos": int(nue_count)
-        })
+def _comuna_numerica(serie):
+    """comuna_calculada como float; tolera valores de texto ('2', '2.0', 'COMUNA 2')."""
+    if pd.api.types.is_numeric_dtype(serie):
+        return serie.astype(float)
+    texto = serie.astype(str).str.upper().str.replace(" ", "", regex=False).str.removeprefix("COMUNA")
+    return pd.to_numeric(texto, errors='coerce')
 
-        for _, r in rows_sem.iterrows():
-            dni_last_comuna[r[COL_DNI]] = r[COL_COMUNA]
-            dni_seen.add(r[COL_DNI])
+def calcular_evolucion_zonas(df_base):
+    """
+    Evolución de DNIs (Nuevos/Recurrentes/Migratorios) por semana para todas las zonas de
+    ZONAS_EVOLUCION. Devuelve una tabla tidy: Semana, comuna, nuevos, recurrentes,
+    migratorios (todas las semanas x todas las zonas, con 0 donde no hubo DNIs).
+
+    Misma lógica que el recorrido semana por semana: un registro por Semana + DNI (el
+    primero en orden cronológico, anónimos incluidos); un DNI es Nuevo la primera semana
+    que aparece, Recurrente si su registro de la semana anterior en que apareció era de
+    esta misma zona y Migratorio si no (otra zona o sin zona).
+    """
+    COL_FECHA = "Fecha Inicio"
+    COL_DNI = "dni_clave"
 
-    return resultados[-8:]
+    df = df_base[[COL_FECHA]].copy()
+    if {"dni", "dni_estado", "DNI_Categorizado"} & set(df_base.columns):
+        # Clave entera (NA = no brindó, todos los anónimos son un mismo "DNI")
+        columnas = [c for c in ["dni", "dni_estado", "DNI_Categorizado"] if c in df_base.columns]
+        df[COL_DNI] = clave_dni(completar_dni(df_base[columnas].copy()))
+    else:
+        df[COL_DNI] = df_base["Persona DNI"]
+    df["comuna"] = _comuna_numerica(df_base["comuna_calculada"])
+    df = df.sort_values(COL_FECHA)
+    df["Semana"] = df[COL_FECHA].dt.to_period("W-SUN").dt.start_time
+    df_sem = df.drop_duplicates(subset=["Semana", COL_DNI])
+
+    # En orden cronológico cada DNI aparece una vez por semana: la fila anterior del
+    # grupo es su semana anterior
+    por_dni = df_sem.groupby(COL_DNI, sort=False, dropna=False)
+    ya_visto = por_dni.cumcount().to_numpy() > 0
+    misma_zona = (por_dni["comuna"].shift() == df_sem["comuna"]).to_numpy(dtype=bool, na_value=False)
+    tipo = np.select([~ya_visto, misma_zona], ["nuevos", "recurrentes"], default="migratorios")
+
+    semanas = np.sort(df_sem["Semana"].unique())
+    en_zona = df_sem["comuna"].isin(ZONAS_EVOLUCION).to_numpy()
+    conteo = pd.crosstab(
+        [df_sem["Semana"].to_numpy()[en_zona], df_sem["comuna"].to_numpy()[en_zona]], tipo[en_zona]
+    )
+    indice = pd.MultiIndex.from_product([semanas, ZONAS_EVOLUCION], names=["Semana", "comuna"])
+    conteo = conteo.reindex(index=indice, columns=["nuevos", "recurrentes", "migratorios"], fill_value=0)
+    return conteo.reset_index()
+
+def evolucion_de_zona(tabla, comuna, semanas=8):
+    """Últimas semanas de una zona en el formato que usan los gráficos."""
+    filas = tabla[tabla["comuna"] == float(comuna)].tail(semanas)
+    return [
+        {"Semana": r.Semana, "recurrentes": int(r.recurrentes), "migratorios": int(r.migratorios), "nuevos": int(r.nuevos)}
+        for r in filas.itertuples(index=False)
+    ]
 
 # =============================================================================
 # GENERACION DE HTML INTERACTIVO Y CALCULOS GLOBALES
 # =============================================================================
 
-def get_stats_data_raw(df_base, comuna_filter_func, base_vals):
+def ultimas_semanas(df_base, n=8):
+    """Las últimas n semanas (lunes) con datos en todo el histórico: columnas de todos los paneles."""
+    return sorted(df_base['Fecha Inicio'].dt.to_period('W-SUN').dt.start_time.unique())[-n:]
+
+def calcular_conteos_paneles(df, semanas):
     """
-    Devuelve un diccionario con los datos crudos para el frontend.
+    Conteos de los indicadores del tablero para todas las comunas en una sola agregación.
+    Devuelve una tabla indexada por (comuna_calculada, Semana), solo para `semanas`, con
+    columnas total, cis, auto (llamados 108) y las llamadas automáticas por categoría de
+    contacto (CATEGORIAS_CONTACTO). Las filas sin comuna quedan con comuna NaN (cuentan
+    para el total de la ciudad).
     """
-    df = comuna_filter_func(df_base).copy()
-    
-    # 8 Semanas fijas
-    all_weeks = sorted(df_base['Fecha Inicio'].dt.to_period('W-SUN').dt.start_time.unique())[-8:]
-    weeks_str = [w.strftime('%d %b').replace('.', '').title() for w in all_weeks]
+    semana = df['Fecha Inicio'].dt.to_period('W-SUN').dt.start_time
+    en_semanas = semana.isin(semanas).to_numpy()
+    df = df[en_semanas]
+
+    auto = (df['Tipo Carta'] == 'AUTOMATICA').to_numpy(dtype=bool, na_value=False)
+    cis = (df['Resultado'] == '01-Traslado efectivo a CIS').to_numpy(dtype=bool, na_value=False)
+    categoria = clasificar_contactos(df).to_numpy()
+
+    indicadores = pd.DataFrame({
+        'comuna_calculada': df['comuna_calculada'].to_numpy(),
+        'Semana': semana[en_semanas].to_numpy(),
+        'total': 1,
+        'cis': cis.astype(int),
+        'auto': auto.astype(int),
+    })
+    for cat in CATEGORIAS_CONTACTO:
+        indicadores[cat] = (auto & (categoria == cat)).astype(int)
+    return indicadores.groupby(['comuna_calculada', 'Semana'], dropna=False).sum()
+
+def conteos_de_comuna(conteos, comuna):
+    """Conteos por Semana de una comuna (vacío si no tuvo registros en esas semanas)."""
+    comunas = conteos.index.get_level_values('comuna_calculada')
+    return conteos[comunas == comuna].droplevel('comuna_calculada')
+
+def armar_panel(conteo, semanas, base_vals):
+    """
+    Datos crudos de un panel para el frontend (semanas + las seis filas de indicadores).
+    conteo: conteos por Semana (ver calcular_conteos_paneles); None = panel sin registros.
+    """
+    weeks_str = [w.strftime('%d %b').replace('.', '').title() for w in semanas]
 
-    if df.empty:
+    if conteo is None:
         return {
             'weeks': weeks_str,
             'rows': [
@@ -148,23 +171,8 @@ def get_stats_data_raw(df_base, comuna_filter_func, base_vals):
             ]
         }
 
-    df['Semana'] = df['Fecha Inicio'].dt.to_period('W-SUN').dt.start_time
-    df['Categoria_contacto'] = df.apply(clasificar_contacto, axis=1)
-
-    df_total_sem = df.groupby('Semana').size().reindex(all_weeks, fill_value=0)
-    
-    df_cis = df[df['Resultado'] == '01-Traslado efectivo a CIS']
-    df_cis_sem = df_cis.groupby('Semana').size().reindex(all_weeks, fill_value=0)
-
-    df_auto = df[df['Tipo Carta'] == 'AUTOMATICA']
-    df_auto_sem = df_auto.groupby('Semana').size().reindex(all_weeks, fill_value=0)
-
-    df_auto_conteo = df_auto.groupby(['Semana', 'Categoria_contacto']).size().unstack(fill_value=0)
-    for col in ['Se contacta', 'No se contacta', 'Sin cubrir']:
-        if col not in df_auto_conteo.columns:
-            df_auto_conteo[col] = 0
-    df_auto_conteo = df_auto_conteo.reindex(all_weeks, fill_value=0)
-
+    conteo = conteo.reindex(semanas, fill_value=0)
+    df_auto_conteo = conteo[CATEGORIAS_CONTACTO]
     totales_auto = df_auto_conteo.sum(axis=1).replace(0, 1)
     df_pct = (df_auto_conteo.div(totales_auto, axis=0) * 100).round(0)
 
@@ -174,24 +182,23 @@ def get_stats_data_raw(df_base, comuna_filter_func, base_vals):
     def get_comb(cat):
         return [f"{int(p)}% ({int(a)})" for p, a in zip(df_pct[cat].values, df_auto_conteo[cat].values)]
 
-    rows.append({'label': 'Intervenciones totales', 'base': base_vals[0], 'vals': get_vals(df_total_sem)})
-    rows.append({'label': 'Derivaciones CIS', 'base': base_vals[1], 'vals': get_vals(df_cis_sem)})
-    rows.append({'label': 'Llamados 108', 'base': base_vals[2], 'vals': get_vals(df_auto_sem)})
+    rows.append({'label': 'Intervenciones totales', 'base': base_vals[0], 'vals': get_vals(conteo['total'])})
+    rows.append({'label': 'Derivaciones CIS', 'base': base_vals[1], 'vals': get_vals(conteo['cis'])})
+    rows.append({'label': 'Llamados 108', 'base': base_vals[2], 'vals': get_vals(conteo['auto'])})
     rows.append({'label': '% Se contacta', 'base': base_vals[3], 'vals': get_comb('Se contacta')})
     rows.append({'label': '% No se contacta', 'base': base_vals[4], 'vals': get_comb('No se contacta')})
     rows.append({'label': '% Sin cubrir', 'base': base_vals[5], 'vals': get_comb('Sin cubrir')})
 
     return {'weeks': weeks_str, 'rows': rows}
 
-def main():
-    print("🚀 Iniciando Generador de Dashboard Interactivo V2 (Fixed)...")
-    
-    service = get_drive_service()
-    print(f"⬇️ Descargando {FILE_NAME_PARQUET}...")
-    df = download_parquet_as_df(service, FILE_NAME_PARQUET, FOLDER_ID_DB)
-    
-    if df.empty: return
+def generar_dashboard(df_limpio):
+    """
+    Genera reporte_autom_bap.html a partir del histórico limpio ya en memoria
+    (ej. el DataFrame que devuelve procesar_datos, sin volver a bajarlo de Drive).
+    """
+    if df_limpio is None or df_limpio.empty: return
 
+    df = df_limpio[COLUMNAS_DASHBOARD].copy()
     df['Fecha Inicio'] = pd.to_datetime(df['Fecha Inicio'])
     last_update = datetime.datetime.now().strftime("%d/%m/%Y %H:%M")
 
@@ -211,6 +218,11 @@ def main():
     # Base Total (Antiguamente Resto - Solicitado usar esta base para Total)
     base_total = ["4344", "341", "2798", "27% (782)", "25% (717)", "46% (1299)"]
 
+    # Una sola agregación para todos los paneles (comunas 1-15 + total)
+    semanas = ultimas_semanas(df)
+    conteos = calcular_conteos_paneles(df, semanas)
+    comunas_con_datos = set(df['comuna_calculada'].dropna().unique())
+
     for c in range(1, 16):
         if c == 2:
             base = base_c2
@@ -218,15 +230,12 @@ def main():
             base = base_c14
         else:
             base = base_dummy
-            
-        all_data[f'c{c}'] = get_stats_data_raw(
-            df, 
-            lambda d, com=c: d[d['comuna_calculada'] == com], 
-            base
-        )
+
+        conteo = conteos_de_comuna(conteos, c) if c in comunas_con_datos else None
+        all_data[f'c{c}'] = armar_panel(conteo, semanas, base)
     
     # Total Ciudad (Usando base_total)
-    all_data['total'] = get_stats_data_raw(df, lambda d: d, base_total)
+    all_data['total'] = armar_panel(conteos.groupby(level='Semana').sum(), semanas, base_total)
 
     def prepare_chart_json(dni_data_list):
         return {
@@ -238,13 +247,10 @@ def main():
             ]
         }
 
-    print("📈 Calculando evolución DNI Comuna 2...")
-    dni_data_c2 = calculate_dni_evolution(df, target_comuna_id=2)
-    chart_json_c2 = prepare_chart_json(dni_data_c2)
-
-    print("📈 Calculando evolución DNI Comuna 14...")
-    dni_data_c14 = calculate_dni_evolution(df, target_comuna_id=14)
-    chart_json_c14 = prepare_chart_json(dni_data_c14)
+    print("📈 Calculando evolución DNI de todas las zonas...")
+    evolucion = calcular_evolucion_zonas(df)
+    chart_json_c2 = prepare_chart_json(evolucion_de_zona(evolucion, 2))
+    chart_json_c14 = prepare_chart_json(evolucion_de_zona(evolucion, 14))
 
     print(f"📝 Generando HTML Interactivo...")
     
@@ -490,5 +496,15 @@ def main():
     
     print("✅ Dashboard Interactivo generado.")
 
+def main():
+    print("🚀 Iniciando Generador de Dashboard Interactivo V2 (Fixed)...")
+    
+    service = get_drive_service()
+    print(f"⬇️ Descargando {FILE_NAME_PARQUET}...")
+    df = descargar_limpio(service, FOLDER_ID_DB, columns=COLUMNAS_DASHBOARD)
+    
+    print(f"🗄️ Cache Drive: {CACHE_DRIVE.resumen()}")
+    generar_dashboard(df)
+
 if __name__ == '__main__':
     main()
@@ -1,19 +1,24 @@
 import pandas as pd
 import numpy as np
-import geopandas as gpd
-from shapely.geometry import Point
 import os
 import io
 import re
+import json
+import datetime
 import gc
+import hashlib
 import unicodedata
 import unidecode
-import zipfile
 from rapidfuzz import process, fuzz
 from google.oauth2 import service_account
 from googleapiclient.discovery import build
 from googleapiclient.http import MediaIoBaseUpload, MediaIoBaseDownload
-import fiona
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from drive_cache import CacheDrive, CAMPOS_METADATA
+from bigquery_loader import cargar_historico
+from clasificador_zonas import obtener_clasificador, MemoComunas, ClasificadorParalelo, COLUMNAS_MEMO
+from esquema_limpio import aplicar_esquema
 
 # ==========================================
 # CONFIGURACIÓN Y UTILIDADES DE GOOGLE (DRIVE & BIGQUERY)
@@ -39,48 +44,67 @@ def get_drive_service():
     creds = get_credentials()
     return build('drive', 'v3', credentials=creds)
 
-def download_file_as_bytes(service, file_id):
-    """Descarga un archivo cualquiera de Drive y devuelve sus bytes."""
+# Cache local compartida por todos los helpers de descarga (ver drive_cache.py)
+CACHE_DRIVE = CacheDrive()
+
+# Tamaño de chunk de descarga (MediaIoBaseDownload). Chunks grandes = menos requests HTTP.
+CHUNK_DESCARGA_BYTES = int(float(os.getenv('BAP_DRIVE_CHUNK_MB', 100)) * 1024 * 1024)
+
+def _descargar_a_archivo(service, file_id, ruta, chunksize=None):
+    """Descarga desde Drive en streaming directo a un archivo en disco (sin buffer en memoria)."""
     print(f"⬇️ Descargando archivo ID: {file_id}...")
     request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    fh.seek(0)
-    return fh.read()
+    with open(ruta, 'wb') as fh:
+        downloader = MediaIoBaseDownload(fh, request, chunksize=chunksize or CHUNK_DESCARGA_BYTES)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
 
-def download_parquet_as_df(service, file_name, folder_id):
-    """Busca y descarga un parquet de Drive a un DataFrame."""
+def download_file_as_bytes(service, file_id, metadata=None):
+    """Descarga un archivo cualquiera de Drive y devuelve sus bytes (sirve desde cache si no cambió)."""
+    with CACHE_DRIVE.abrir(service, file_id, _descargar_a_archivo, metadata=metadata) as ruta:
+        with open(ruta, 'rb') as f:
+            return f.read()
+
+def read_drive_parquet(service, file_id, metadata=None, columns=None, filters=None):
+    """
+    Lee un parquet de Drive sin copiarlo a memoria: el archivo (cacheado o recién
+    descargado en streaming) se abre con memory_map y pyarrow solo materializa las
+    columnas pedidas. 'filters' usa la sintaxis de pyarrow (ej. [('comuna_calculada', '==', 2)]).
+    """
+    with CACHE_DRIVE.abrir(service, file_id, _descargar_a_archivo, metadata=metadata) as ruta:
+        if columns is not None:
+            disponibles = set(pq.read_schema(ruta, memory_map=True).names)
+            columns = [c for c in columns if c in disponibles]
+        return pd.read_parquet(ruta, engine='pyarrow', columns=columns, filters=filters, memory_map=True)
+
+def download_parquet_as_df(service, file_name, folder_id, columns=None, filters=None):
+    """Busca y descarga un parquet de Drive a un DataFrame (opcionalmente solo algunas columnas/filas)."""
     print(f"⬇️ Buscando '{file_name}' en Drive...")
     query = f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
-    results = service.files().list(q=query, fields="files(id)").execute()
+    results = service.files().list(q=query, fields=f"files({CAMPOS_METADATA})").execute()
     files = results.get('files', [])
     
     if not files:
         print(f"⚠️ Archivo {file_name} no encontrado. Se creará uno nuevo.")
         return pd.DataFrame() 
 
-    file_id = files[0]['id']
-    request = service.files().get_media(fileId=file_id)
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    
-    fh.seek(0)
-    return pd.read_parquet(fh)
+    # La metadata del list ya trae md5Checksum: no hace falta otra llamada para validar la cache
+    return read_drive_parquet(service, files[0]['id'], metadata=files[0], columns=columns, filters=filters)
 
 def upload_df_as_parquet(service, df, file_name, folder_id):
-    """Sube un DataFrame como parquet a Drive (sobreescribe o crea)."""
+    """Sube un DataFrame como parquet a Drive (sobreescribe o crea). Devuelve el ID del archivo."""
     print(f"⬆️ Subiendo '{file_name}' a Drive...")
     fh = io.BytesIO()
     df.to_parquet(fh, index=False, engine='pyarrow', compression='snappy')
     fh.seek(0)
-    
-    media = MediaIoBaseUpload(fh, mimetype='application/octet-stream', resumable=True)
+    return upload_bytes(service, fh, file_name, folder_id)
+
+def upload_bytes(service, fh, file_name, folder_id, mimetype='application/octet-stream'):
+    """Sube un buffer a Drive (sobreescribe o crea). Devuelve el ID del archivo."""
+    # Lo que subimos queda en cache: la próxima lectura (incluso desde otro script) es local
+    CACHE_DRIVE.guardar_subida(fh.getvalue())
+    media = MediaIoBaseUpload(fh, mimetype=mimetype, resumable=True)
     
     query = f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
     results = service.files().list(q=query, fields="files(id)").execute()
@@ -92,40 +116,380 @@ def upload_df_as_parquet(service, df, file_name, folder_id):
         print(f"✅ {file_name} actualizado en Drive.")
     else:
         file_metadata = {'name': file_name, 'parents': [folder_id]}
-        service.files().create(body=file_metadata, media_body=media).execute()
+        file_id = service.files().create(body=file_metadata, media_body=media, fields='id').execute()['id']
         print(f"✅ {file_name} creado en Drive.")
+    return file_id
+
+def download_json(service, file_name, folder_id):
+    """Busca y descarga un JSON de Drive. Devuelve None si no existe."""
+    query = f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
+    results = service.files().list(q=query, fields=f"files({CAMPOS_METADATA})").execute()
+    files = results.get('files', [])
+    if not files:
+        return None
+    return json.loads(download_file_as_bytes(service, files[0]['id'], metadata=files[0]).decode('utf-8'))
+
+def existe_en_drive(service, file_name, folder_id):
+    """True si hay un archivo con ese nombre en la carpeta (sin descargarlo)."""
+    query = f"name = '{file_name}' and '{folder_id}' in parents and trashed = false"
+    return bool(service.files().list(q=query, fields="files(id)").execute().get('files'))
+
+def upload_json(service, data, file_name, folder_id):
+    """Sube un objeto serializable como JSON a Drive (sobreescribe o crea)."""
+    fh = io.BytesIO(json.dumps(data, ensure_ascii=False, indent=1).encode('utf-8'))
+    return upload_bytes(service, fh, file_name, folder_id, mimetype='application/json')
+
+def get_bigquery_client(project_id):
+    """Cliente de BigQuery con las credenciales compartidas."""
+    return bigquery.Client(credentials=get_credentials(), project=project_id)
 
-def upload_to_bigquery(df, project_id, dataset_id, table_id):
-    """Sube el DataFrame a BigQuery reemplazando la tabla existente."""
-    destination_table = f"{dataset_id}.{table_id}"
-    print(f"⬆️ Iniciando carga a BigQuery: {destination_table} en proyecto {project_id}...")
+def upload_to_bigquery(df, project_id, dataset_id, table_id, semana_desde=None, client=None, modo_carga=None):
+    """
+    Sube el DataFrame a BigQuery (tabla particionada por semana y clusterizada por comuna).
+    semana_desde=None reemplaza la tabla completa; con una fecha solo se reemplazan las
+    particiones desde esa semana (staging + MERGE, ver bigquery_loader.py).
+    modo_carga: 'parquet' (esquema fijo, default) o 'dataframe' (esquema inferido).
+    Los errores se propagan: la corrida falla y no se guarda el estado en Drive.
+    """
+    destination_table = f"{project_id}.{dataset_id}.{table_id}"
+    print(f"⬆️ Iniciando carga a BigQuery: {destination_table}...")
     
-    try:
-        creds = get_credentials()
-        # if_exists='replace' es CRÍTICO para mantener la consistencia de tu lógica de históricos
-        df.to_gbq(
-            destination_table, 
-            project_id=project_id, 
-            if_exists='replace',
-            credentials=creds,
-            progress_bar=False
-        )
-        print("✅ Carga a BigQuery exitosa.")
-    except Exception as e:
-        print(f"❌ Error subiendo a BigQuery: {e}")
+    client = client or get_bigquery_client(project_id)
+    cargar_historico(client, df, destination_table, semana_desde=semana_desde, modo=modo_carga)
+    print("✅ Carga a BigQuery exitosa.")
+
+# ==========================================
+# HISTÓRICO CRUDO PARTICIONADO (UN PARQUET POR SEMANA ISO)
+# ==========================================
+
+# Layout en la carpeta DB:
+#   historico_v2_manifiesto.json           -> índice de particiones
+#   historico_v2_semana_<AAAA>-W<SS>.parquet -> filas cuya 'Fecha Inicio' cae en esa semana ISO
+# El monolítico 2025_historico_v2.parquet solo se lee una vez para migrarlo.
+NOMBRE_CRUDO_MONOLITICO = "2025_historico_v2.parquet"
+NOMBRE_MANIFIESTO_CRUDO = "historico_v2_manifiesto.json"
+PREFIJO_PARTICION_CRUDO = "historico_v2_semana_"
+PARTICION_SIN_FECHA = "sin_fecha"
+COLUMNAS_FECHA_CRUDO = ['Fecha Inicio', 'Fecha Fin', 'Recurso Fecha Liberado', 'Recurso Fecha asignacion', 'Recurso Arribo']
+
+def normalizar_fechas_crudo(df):
+    """Convierte a datetime las columnas de fecha del crudo (in place)."""
+    if not df.empty:
+        for col in COLUMNAS_FECHA_CRUDO:
+            if col in df.columns:
+                df[col] = pd.to_datetime(df[col], errors='coerce')
+    return df
+
+def clave_semana_iso(fechas):
+    """Devuelve la partición ('AAAA-WSS') de cada fecha según su semana ISO."""
+    iso = fechas.dt.isocalendar()
+    claves = iso['year'].astype(str) + '-W' + iso['week'].astype(str).str.zfill(2)
+    return claves.where(fechas.notna(), PARTICION_SIN_FECHA)
+
+def nombre_particion_crudo(clave):
+    return f"{PREFIJO_PARTICION_CRUDO}{clave}.parquet"
+
+def _entrada_manifiesto(df_particion, file_id, col_fecha='Fecha Inicio'):
+    fechas = df_particion[col_fecha]
+    return {
+        'file_id': file_id,
+        'filas': int(len(df_particion)),
+        'fecha_min': None if fechas.isna().all() else fechas.min().isoformat(),
+        'fecha_max': None if fechas.isna().all() else fechas.max().isoformat(),
+    }
+
+def cargar_manifiesto_crudo(service, folder_id):
+    """
+    Descarga el manifiesto de particiones del crudo.
+    Si todavía no existe, migra el monolítico (si lo hay) a particiones semanales.
+    """
+    manifiesto = download_json(service, NOMBRE_MANIFIESTO_CRUDO, folder_id)
+    if manifiesto is not None:
+        print(f"🗂️ Manifiesto del crudo: {len(manifiesto['particiones'])} particiones semanales.")
+        return manifiesto
+
+    manifiesto = {'version': 1, 'particiones': {}}
+    df_mono = download_parquet_as_df(service, NOMBRE_CRUDO_MONOLITICO, folder_id)
+    if not df_mono.empty:
+        print(f"🔀 Migrando {NOMBRE_CRUDO_MONOLITICO} a particiones semanales ({len(df_mono)} filas)...")
+        normalizar_fechas_crudo(df_mono)
+        agregar_huellas(df_mono)
+        manifiesto = escribir_particiones_crudo(service, df_mono, folder_id, manifiesto, reemplazar=True)
+    return manifiesto
+
+def hay_crudo(service, folder_id):
+    """True si ya existe un histórico crudo (particionado o el monolítico sin migrar)."""
+    return existe_en_drive(service, NOMBRE_MANIFIESTO_CRUDO, folder_id) or \
+        existe_en_drive(service, NOMBRE_CRUDO_MONOLITICO, folder_id)
+
+def leer_particion_crudo(service, manifiesto, clave):
+    """Descarga una partición semanal del crudo. Devuelve un DataFrame vacío si no existe."""
+    entrada = manifiesto['particiones'].get(clave)
+    if entrada is None:
+        return pd.DataFrame()
+    df = read_drive_parquet(service, entrada['file_id'])
+    # Particiones escritas antes del índice de huellas: se calculan al vuelo
+    if 'id_fila' not in df.columns:
+        normalizar_fechas_crudo(df)
+        agregar_huellas(df)
+    return df
+
+def leer_historico_particionado(service, folder_id, semanas=None, manifiesto=None):
+    """
+    Lee el crudo particionado. semanas=None carga todas las particiones;
+    si se pasa una lista de claves ('AAAA-WSS') solo se descargan esas.
+    """
+    if manifiesto is None:
+        manifiesto = cargar_manifiesto_crudo(service, folder_id)
+    claves = sorted(manifiesto['particiones']) if semanas is None else [c for c in semanas if c in manifiesto['particiones']]
+    if not claves:
+        return pd.DataFrame()
+
+    print(f"⬇️ Leyendo {len(claves)} particiones del crudo...")
+    partes = [leer_particion_crudo(service, manifiesto, c) for c in claves]
+    df = pd.concat(partes, ignore_index=True)
+    return normalizar_fechas_crudo(df)
+
+def escribir_particiones_crudo(service, df_nuevos, folder_id, manifiesto, reemplazar=False, col_fecha='Fecha Inicio'):
+    """
+    Escribe solo las particiones afectadas por df_nuevos y actualiza el manifiesto en Drive.
+    Con reemplazar=False las filas se agregan a la partición existente; si una fila ya
+    existía (misma id_fila) se reemplaza por la versión nueva.
+    """
+    claves = clave_semana_iso(df_nuevos[col_fecha])
+    for clave, df_semana in df_nuevos.groupby(claves, sort=True):
+        if not reemplazar:
+            df_prev = leer_particion_crudo(service, manifiesto, clave)
+            if not df_prev.empty:
+                normalizar_fechas_crudo(df_prev)
+                # Upsert: la versión nueva de una fila reemplaza a la anterior (misma id_fila)
+                if 'id_fila' in df_semana.columns:
+                    df_prev = df_prev[~df_prev['id_fila'].isin(df_semana['id_fila'])]
+                df_semana = pd.concat([df_prev, df_semana], ignore_index=True)
+        file_id = upload_df_as_parquet(service, df_semana, nombre_particion_crudo(clave), folder_id)
+        manifiesto['particiones'][clave] = _entrada_manifiesto(df_semana, file_id, col_fecha)
+
+    upload_json(service, manifiesto, NOMBRE_MANIFIESTO_CRUDO, folder_id)
+    return manifiesto
+
+# ==========================================
+# ÍNDICE DE HUELLAS DEL CRUDO (CLAVE DE NEGOCIO + HASH DE CONTENIDO)
+# ==========================================
+
+# Columnas que identifican una carta y no cambian cuando se edita (id_fila suma el n° de ocurrencia)
+COLUMNAS_CLAVE_FILA = ['Fecha Inicio', 'Tipo Carta', 'Latitud', 'Longitud']
+COLUMNAS_HUELLA = ['id_fila', 'hash_contenido']
+NOMBRE_INDICE_HUELLAS = "historico_v2_huellas.parquet"
+
+def calcular_id_fila(df):
+    """
+    Clave de negocio estable (int64) de cada fila: hash de COLUMNAS_CLAVE_FILA + número de
+    ocurrencia. Varias personas abordadas en la misma carta comparten COLUMNAS_CLAVE_FILA:
+    la ocurrencia (orden de aparición dentro de esa clave en el Excel) las distingue. La
+    primera ocurrencia conserva el hash de la clave sola (huellas ya guardadas siguen valiendo).
+    """
+    claves = df[COLUMNAS_CLAVE_FILA].copy()
+    # El hash depende de la resolución del datetime: se fija en ns para que crudo y limpio coincidan
+    claves['Fecha Inicio'] = claves['Fecha Inicio'].astype('datetime64[ns]')
+    ids = pd.util.hash_pandas_object(claves, index=False).to_numpy()
+    ocurrencia = pd.Series(ids).groupby(ids, sort=False).cumcount().to_numpy()
+    repetidas = ocurrencia > 0
+    if repetidas.any():
+        ids = ids.copy()
+        ids[repetidas] = pd.util.hash_pandas_object(
+            pd.DataFrame({'clave': ids[repetidas], 'ocurrencia': ocurrencia[repetidas]}), index=False
+        ).to_numpy()
+    return pd.Series(ids.view('int64'), index=df.index)
+
+FORMATO_FECHA_HUELLA = '%Y-%m-%d %H:%M:%S.%f'
+
+def _valor_canonico(valor):
+    """Texto canónico de un valor suelto (columnas object con tipos mezclados)."""
+    if valor is None or (not isinstance(valor, str) and pd.isna(valor)):
+        return None
+    if isinstance(valor, (pd.Timestamp, datetime.datetime)):
+        return pd.Timestamp(valor).strftime(FORMATO_FECHA_HUELLA)
+    if isinstance(valor, (float, np.floating)) and float(valor).is_integer():
+        return str(int(valor))
+    if isinstance(valor, (bool, np.bool_)):
+        return str(bool(valor))
+    return str(valor)
+
+def _columna_canonica(serie):
+    """
+    Texto canónico de una columna, independiente del dtype inferido al leer el Excel:
+    fechas con formato fijo (sin importar la resolución), floats enteros como enteros
+    (30123456.0 == 30123456) y cualquier faltante (NaN/None/NaT/NA) como None.
+    """
+    if pd.api.types.is_datetime64_any_dtype(serie):
+        if serie.dt.tz is not None:
+            serie = serie.dt.tz_localize(None)
+        return serie.dt.strftime(FORMATO_FECHA_HUELLA).astype(object).where(serie.notna(), None)
+    if pd.api.types.is_numeric_dtype(serie) and not pd.api.types.is_bool_dtype(serie):
+        numeros = serie.astype('float64')
+        enteros = np.isfinite(numeros) & (numeros % 1 == 0)
+        texto = numeros.astype(str).astype(object)
+        texto[enteros] = numeros[enteros].astype('int64').astype(str)
+        return texto.where(numeros.notna(), None)
+    # object/str/category: se canonicaliza cada valor distinto una sola vez
+    codigos, unicos = pd.factorize(serie.astype(object), use_na_sentinel=True)
+    canonicos = np.array([_valor_canonico(v) for v in unicos] + [None], dtype=object)
+    return pd.Series(canonicos[codigos], index=serie.index)
+
+def calcular_hash_contenido(df):
+    """
+    Hash (int64) del contenido de la fila: cambia si se edita cualquier campo (Estado,
+    Cierre Supervisor...) pero no si solo cambia cómo pandas infirió los tipos.
+    Cada valor no vacío se hashea con una clave derivada del nombre de su columna y se
+    suman los hashes: el orden de las columnas y las columnas vacías (presentes o no en
+    el Excel) no influyen.
+    """
+    total = np.zeros(len(df), dtype='uint64')
+    for col in df.columns:
+        if col in COLUMNAS_HUELLA:
+            continue
+        valores = _columna_canonica(df[col]).to_numpy()
+        presentes = pd.notna(valores)
+        clave = hashlib.md5(str(col).encode('utf-8')).hexdigest()[:16]
+        hashes = pd.util.hash_array(np.where(presentes, valores, ''), hash_key=clave, categorize=True)
+        total += np.where(presentes, hashes, np.uint64(0))
+    return pd.Series(total.view('int64'), index=df.index)
+
+def agregar_huellas(df):
+    """Agrega id_fila y hash_contenido al DataFrame del crudo (in place)."""
+    df['id_fila'] = calcular_id_fila(df)
+    df['hash_contenido'] = calcular_hash_contenido(df)
+    return df
+
+def cargar_indice_huellas(service, folder_id, manifiesto):
+    """Descarga el índice de huellas; si no existe lo construye una vez desde las particiones."""
+    indice = download_parquet_as_df(service, NOMBRE_INDICE_HUELLAS, folder_id)
+    if indice.empty and manifiesto['particiones']:
+        print("🔑 Construyendo índice de huellas desde el crudo particionado...")
+        indice = leer_historico_particionado(service, folder_id, manifiesto=manifiesto)[COLUMNAS_HUELLA]
+    if indice.empty:
+        indice = pd.DataFrame({'id_fila': pd.Series(dtype='int64'), 'hash_contenido': pd.Series(dtype='int64')})
+    return indice.drop_duplicates('id_fila', keep='last')
+
+def detectar_nuevas_y_modificadas(df_nuevo, indice):
+    """
+    Anti-join vectorizado contra el índice. Devuelve (mask_nuevas, mask_modificadas)
+    alineadas con df_nuevo: nuevas = id_fila desconocida; modificadas = id_fila conocida
+    con otro hash_contenido.
+    """
+    # get_indexer en vez de map: map pasaría los hashes int64 a float (NaN) y perdería precisión
+    posiciones = pd.Index(indice['id_fila']).get_indexer(df_nuevo['id_fila'])
+    nuevas = posiciones == -1
+    hash_prev = indice['hash_contenido'].to_numpy()[np.where(nuevas, 0, posiciones)] if len(indice) else posiciones
+    modificadas = ~nuevas & (hash_prev != df_nuevo['hash_contenido'].to_numpy())
+    return pd.Series(nuevas, index=df_nuevo.index), pd.Series(modificadas, index=df_nuevo.index)
+
+def actualizar_indice_huellas(service, indice, df_upsert, folder_id):
+    indice = pd.concat([indice, df_upsert[COLUMNAS_HUELLA]], ignore_index=True)
+    indice = indice.drop_duplicates('id_fila', keep='last').reset_index(drop=True)
+    upload_df_as_parquet(service, indice, NOMBRE_INDICE_HUELLAS, folder_id)
+    return indice
+
+# ==========================================
+# MEMO DE COORDENADAS -> COMUNA (FASE 2)
+# ==========================================
+
+# Vive junto al histórico en la carpeta DB. Se descarta solo si cambian los archivos de
+# zonas (checksum_zonas distinto al del artefacto compilado, ver clasificador_zonas.py).
+NOMBRE_MEMO_COMUNAS = "comunas_memo.parquet"
+
+def cargar_memo_comunas(service, folder_id, checksum):
+    df_memo = download_parquet_as_df(service, NOMBRE_MEMO_COMUNAS, folder_id)
+    if df_memo.empty or 'checksum_zonas' not in df_memo.columns:
+        return MemoComunas(checksum)
+    if df_memo['checksum_zonas'].iloc[0] != checksum:
+        print("🔁 Cambiaron los archivos de zonas: se descarta el memo de coordenadas.")
+        return MemoComunas(checksum)
+    return MemoComunas(checksum, df_memo[COLUMNAS_MEMO])
+
+def guardar_memo_comunas(service, memo, folder_id):
+    """Sube el memo solo si se clasificaron coordenadas nuevas."""
+    if memo.nuevas:
+        upload_df_as_parquet(service, memo.tabla(), NOMBRE_MEMO_COMUNAS, folder_id)
+        print(f"✅ Memo de coordenadas actualizado: {len(memo)} coordenadas ({memo.nuevas} nuevas).")
+
+
+# ==========================================
+# CACHE DE CATEGORIZACIÓN (FASE 3)
+# ==========================================
+
+def cargar_cache_categorias(service, folder_id):
+    version = version_reglas_categorizacion()
+    df_cache = download_parquet_as_df(service, NOMBRE_CACHE_CATEGORIAS, folder_id)
+    if df_cache.empty or 'version_reglas' not in df_cache.columns:
+        return CategorizadorCierres(version)
+    if df_cache['version_reglas'].iloc[0] != version:
+        print("🔁 Cambiaron las reglas de categorización: se descarta la cache de categorías.")
+        return CategorizadorCierres(version)
+    return CategorizadorCierres(version, zip(df_cache['texto_limpio'], df_cache['categoria_final']))
+
+def guardar_cache_categorias(service, categorizador, folder_id):
+    """Sube la cache solo si se resolvieron textos nuevos."""
+    if categorizador.nuevas:
+        upload_df_as_parquet(service, categorizador.tabla(), NOMBRE_CACHE_CATEGORIAS, folder_id)
+        print(f"✅ Cache de categorías actualizada: {len(categorizador.cache)} textos ({categorizador.nuevas} nuevos).")
+
+# ==========================================
+# SNAPSHOT DE EVOLUCIÓN DE DNI (TIPO_EVOLUCION)
+# ==========================================
+
+# Estado por DNI (última comuna, primera/última semana, semanas vistas) al comenzar la
+# última semana del limpio (semana_corte). Con él solo se clasifican las semanas >= corte;
+# si cambian filas anteriores al corte o no coincide con el limpio se recorre todo.
+NOMBRE_ESTADO_DNI = "2025_historico_limpio_estado_dni.parquet"
+
+def cargar_estado_dni(service, folder_id, ultima_semana):
+    """ultima_semana: última semana del limpio anterior (el snapshot tiene que ser de esa corrida)."""
+    df_estado = download_parquet_as_df(service, NOMBRE_ESTADO_DNI, folder_id)
+    if df_estado.empty or not {'semana_corte', 'dni_clave'} <= set(df_estado.columns):
+        return None
+    if pd.isna(ultima_semana) or df_estado['semana_corte'].iloc[0] != ultima_semana:
+        print("🔁 El snapshot de DNI no corresponde al limpio anterior: se descarta.")
+        return None
+    return EstadoEvolucionDNI(df_estado['semana_corte'].iloc[0], df_estado)
+
+def guardar_estado_dni(service, estado, folder_id):
+    if pd.isna(estado.semana_corte):
+        return
+    upload_df_as_parquet(service, estado.tabla(), NOMBRE_ESTADO_DNI, folder_id)
+    print(f"✅ Snapshot de DNI actualizado: {len(estado.dnis)} DNIs al inicio de la semana {estado.semana_corte:%Y-%m-%d}.")
 
 # ==========================================
 # FUNCIONES DE LIMPIEZA (TU LÓGICA)
 # ==========================================
 
-def limpiar_texto(nombre):
-    if pd.isna(nombre): return None
-    nombre = str(nombre).upper()
-    nombre = ''.join(c for c in unicodedata.normalize('NFD', nombre) if unicodedata.category(c) != 'Mn')
-    nombre = re.sub(r'[-.,]', ' ', nombre)
-    nombre = re.sub(r'[^A-Z ]', '', nombre)
-    nombre = re.sub(r'\s+', ' ', nombre).strip()
-    return nombre if nombre else None
+# --- NORMALIZACIÓN DE NOMBRES EN BLOQUE ---
+# Regla: upper, NFD sin marcas, [-.,] -> espacio, quitar todo lo que no sea A-Z/espacio,
+# colapsar espacios; vacío -> None. Los primeros pasos son carácter a carácter, así que
+# se resumen en una tabla de str.translate que se arma una sola vez por carácter
+# distinto. Después solo queda colapsar espacios.
+_TABLA_NOMBRES = {}
+
+def _traducir_caracter(c):
+    descompuesto = ''.join(x for x in unicodedata.normalize('NFD', c.upper()) if unicodedata.category(x) != 'Mn')
+    descompuesto = re.sub(r'[-.,]', ' ', descompuesto)
+    return re.sub(r'[^A-Z ]', '', descompuesto)
+
+def normalizar_nombres(serie):
+    """Normaliza nombres/apellidos: corre una vez por valor distinto y se propaga con factorize."""
+    codigos, unicos = pd.factorize(serie.astype(str))
+    unicos = np.asarray(unicos, dtype=object)
+
+    nuevos = set(''.join(unicos)) - _TABLA_NOMBRES.keys()
+    _TABLA_NOMBRES.update({c: _traducir_caracter(c) for c in nuevos})
+    tabla = str.maketrans(_TABLA_NOMBRES)
+
+    limpios = np.empty(len(unicos) + 1, dtype=object)
+    for i, u in enumerate(unicos):
+        limpio = ' '.join(u.translate(tabla).split())
+        limpios[i] = limpio if limpio else None
+    limpios[-1] = None  # nulos (código -1)
+    return pd.Series(limpios[codigos], index=serie.index).infer_objects()
 
 def limpiar_texto_cierre(s):
     if pd.isna(s): return ""
@@ -137,36 +501,133 @@ def limpiar_texto_cierre(s):
     return s.strip()
 
 # --- PATRONES REGEX PARA DNI ---
-PATRON_EXTRANJERO = re.compile(r'(extranjero|paraguay|venezol|colombian|uruguay|brasil|chilen|peruano|mexican|español|dominican|dominicana|pasaporte|c\.?d\.?[ie]:?|rnm|cedula|ciudadano\s+extranjero)', flags=re.IGNORECASE)
-PATRON_NO_BRINDO_GENERICOS = re.compile(r'(no\s*brind|no\s*bri[nm]d|no\s*aporta|no\s*aporto|no\s*indica|no\s*sabe|no\s*recuerda|no\s*recuerd|no\s*tiene|nunca\s*tuvo|sin\s*dni|sin\s*dato|sin\s*inform|ilegible|invisible|no\s*visible|exhib|no\s*lo\s*sabe|menor\s*de\s*edad)', flags=re.IGNORECASE)
+PATRON_EXTRANJERO = re.compile(r'(?:extranjero|paraguay|venezol|colombian|uruguay|brasil|chilen|peruano|mexican|español|dominican|dominicana|pasaporte|c\.?d\.?[ie]:?|rnm|cedula|ciudadano\s+extranjero)', flags=re.IGNORECASE)
+PATRON_NO_BRINDO_GENERICOS = re.compile(r'(?:no\s*brind|no\s*bri[nm]d|no\s*aporta|no\s*aporto|no\s*indica|no\s*sabe|no\s*recuerda|no\s*recuerd|no\s*tiene|nunca\s*tuvo|sin\s*dni|sin\s*dato|sin\s*inform|ilegible|invisible|no\s*visible|exhib|no\s*lo\s*sabe|menor\s*de\s*edad)', flags=re.IGNORECASE)
 PATRON_NO_BRINDO_SIMBOLOS = re.compile(r'^[xX\*\-\.]+$', flags=re.IGNORECASE)
 PATRON_LETRAS_CORTAS = re.compile(r'^[A-Za-z]{1,3}$')
 PATRON_SOLO_LETRAS = re.compile(r'^[A-Za-z]+$')
 
+VALOR_DNI_NO_BRINDO = 'NO BRINDO/NO VISIBLE'
+VALOR_DNI_EXTRANJERO = 'CONTACTO EXTRANJERO'
+
+def _categorizar_dni_unicos(valores):
+    """
+    Reglas de DNI aplicadas en bloque sobre valores únicos (ya pasados a str, sin nulos).
+    Devuelve (valor, motivo) como arrays object. Mismo orden de reglas que la versión
+    fila a fila: la primera que matchea gana (np.select).
+    """
+    # dtype object: las regex corren con el motor re de Python (el de pyarrow difiere en
+    # \D y en mayúsculas/minúsculas fuera de ASCII)
+    s = pd.Series(valores, dtype=object).str.strip()
+    s_lower = s.str.lower()
+    digits = s.str.replace(r'\D', '', regex=True)
+    n_digits = digits.str.len()
+
+    solo_letras = s.str.match(PATRON_SOLO_LETRAS).to_numpy(bool)
+    letras_repetidas = np.zeros(len(s), dtype=bool)
+    letras_repetidas[solo_letras] = [len(set(x)) <= 2 for x in s_lower[solo_letras]]
+
+    condiciones = [
+        (s == '').to_numpy(bool),
+        s_lower.str.contains(PATRON_NO_BRINDO_GENERICOS).to_numpy(bool),
+        (s.str.match(PATRON_NO_BRINDO_SIMBOLOS) | s.str.match(PATRON_LETRAS_CORTAS)).to_numpy(bool),
+        letras_repetidas,
+        s_lower.str.contains(PATRON_EXTRANJERO).to_numpy(bool),
+        n_digits.between(6, 10).to_numpy(bool),
+        ((n_digits < 6) | s_lower.str.contains(r'[A-Za-z]')).to_numpy(bool),
+    ]
+    motivos = ['empty', 'patron_no_brindo_genericos', 'simbolos_o_letras_cortas', 'solo_letras_repetidas',
+               'patron_extranjero', 'dni_valido', 'texto_o_corto']
+    motivo = np.select(condiciones, motivos, default='resto_no_brindo').astype(object)
+
+    valor = np.full(len(s), VALOR_DNI_NO_BRINDO, dtype=object)
+    valor[motivo == 'patron_extranjero'] = VALOR_DNI_EXTRANJERO
+    validos = motivo == 'dni_valido'
+    valor[validos] = [int(d) for d in digits[validos]]
+    return valor, motivo
+
 def limpiar_y_categorizar_dni_v3(df, columna_original, columna_salida=None, crear_motivo=True):
     if columna_salida is None: columna_salida = columna_original
     motivo_col = f"{columna_salida}_motivo" if crear_motivo else None
 
-    def procesar_valor(v):
-        if pd.isna(v): return ('NO BRINDO/NO VISIBLE', 'nan')
-        s = str(v).strip()
-        if s == '': return ('NO BRINDO/NO VISIBLE', 'empty')
-        s_lower = s.lower()
-        if PATRON_NO_BRINDO_GENERICOS.search(s_lower): return ('NO BRINDO/NO VISIBLE', 'patron_no_brindo_genericos')
-        if PATRON_NO_BRINDO_SIMBOLOS.match(s) or PATRON_LETRAS_CORTAS.match(s): return ('NO BRINDO/NO VISIBLE', 'simbolos_o_letras_cortas')
-        if PATRON_SOLO_LETRAS.match(s) and len(set(s_lower)) <= 2: return ('NO BRINDO/NO VISIBLE', 'solo_letras_repetidas')
-        if PATRON_EXTRANJERO.search(s_lower): return ('CONTACTO EXTRANJERO', 'patron_extranjero')
-        digits = re.sub(r'\D', '', s)
-        if 6 <= len(digits) <= 10: return (int(digits), 'dni_valido')
-        if len(digits) < 6 or re.search(r'[A-Za-z]', s_lower): return ('NO BRINDO/NO VISIBLE', 'texto_o_corto')
-        return ('NO BRINDO/NO VISIBLE', 'resto_no_brindo')
-
     print(f"⚙️ Procesando DNI: {columna_original}...")
-    resultados = df[columna_original].apply(procesar_valor)
-    df[columna_salida] = resultados.apply(lambda x: x[0])
-    if crear_motivo: df[motivo_col] = resultados.apply(lambda x: x[1])
+    # Las reglas corren una vez por valor distinto y se propagan con los códigos de factorize.
+    # Se factoriza el texto (str(v)) y no el valor: 30000360 y 30000360.0 son iguales para
+    # pandas pero dan dígitos distintos.
+    codigos, unicos = pd.factorize(df[columna_original].astype(str))
+    valor_u, motivo_u = _categorizar_dni_unicos(np.asarray(unicos, dtype=object))
+
+    # Nulos (código -1) al final: ('NO BRINDO/NO VISIBLE', 'nan')
+    valor_u = np.append(valor_u, np.array([VALOR_DNI_NO_BRINDO], dtype=object))
+    motivo_u = np.append(motivo_u, np.array(['nan'], dtype=object))
+    codigos = np.where(codigos < 0, len(valor_u) - 1, codigos)
+
+    df[columna_salida] = pd.Series(valor_u[codigos], index=df.index).infer_objects()
+    if crear_motivo: df[motivo_col] = pd.Series(motivo_u[codigos], index=df.index).infer_objects()
+    return df
+
+# --- DNI COMO ENTERO + ESTADO ---
+# dni: Int64 con el número (NA si no es un DNI válido); dni_estado: valido / no_brindo /
+# extranjero. Dedup, groupby y joins por DNI usan la clave entera (clave_dni). DNI_Categorizado
+# (texto) se sigue guardando por compatibilidad (vistas de BigQuery) y es derivable de ambas.
+ESTADO_DNI_VALIDO = 'valido'
+ESTADO_DNI_NO_BRINDO = 'no_brindo'
+ESTADO_DNI_EXTRANJERO = 'extranjero'
+ESTADOS_DNI = [ESTADO_DNI_VALIDO, ESTADO_DNI_NO_BRINDO, ESTADO_DNI_EXTRANJERO]
+# Todos los contactos extranjeros son un mismo "DNI" (como el texto 'CONTACTO EXTRANJERO')
+CLAVE_DNI_EXTRANJERO = -1
+
+def codificar_dni(dni_categorizado):
+    """(dni, dni_estado) a partir de DNI_Categorizado, una vez por valor distinto."""
+    codigos, unicos = pd.factorize(dni_categorizado.astype(str))
+    unicos = pd.Series(unicos, dtype=object)
+    validos = unicos.str.fullmatch(r'[0-9]+').to_numpy(bool)
+    extranjeros = (unicos == VALOR_DNI_EXTRANJERO).to_numpy(bool)
+
+    dni_u = np.zeros(len(unicos) + 1, dtype='int64')
+    dni_u[:-1][validos] = unicos[validos].astype('int64')
+    estado_u = np.append(np.select([validos, extranjeros], [0, 2], default=1), 1)  # códigos de ESTADOS_DNI
+    codigos = np.where(codigos < 0, len(unicos), codigos)
+
+    dni = pd.array(dni_u[codigos], dtype='Int64')
+    dni[estado_u[codigos] != 0] = pd.NA
+    estado = pd.Categorical.from_codes(estado_u[codigos], categories=ESTADOS_DNI)
+    return pd.Series(dni, index=dni_categorizado.index), pd.Series(estado, index=dni_categorizado.index)
+
+def derivar_dni_categorizado(dni, dni_estado):
+    """DNI_Categorizado (texto) a partir de dni + dni_estado."""
+    salida = pd.Series(VALOR_DNI_NO_BRINDO, index=dni.index, dtype=object)
+    salida[(dni_estado == ESTADO_DNI_EXTRANJERO).to_numpy(bool)] = VALOR_DNI_EXTRANJERO
+    validos = (dni_estado == ESTADO_DNI_VALIDO).to_numpy(bool)
+    salida[validos] = dni[validos].astype('int64').astype(str)
+    return salida.astype(str)
+
+def completar_dni(df):
+    """
+    Agrega (in place) dni/dni_estado o DNI_Categorizado si faltan (limpios anteriores).
+    Si dni_estado existe pero tiene filas vacías (p. ej. tras concatenar con filas sin
+    codificar), esas filas se codifican desde DNI_Categorizado.
+    """
+    if 'DNI_Categorizado' not in df.columns:
+        if {'dni', 'dni_estado'} <= set(df.columns):
+            df['DNI_Categorizado'] = derivar_dni_categorizado(df['dni'], df['dni_estado'])
+        return df
+    if not {'dni', 'dni_estado'} <= set(df.columns):
+        df['dni'], df['dni_estado'] = codificar_dni(df['DNI_Categorizado'])
+        return df
+    faltan = df['dni_estado'].isna().to_numpy()
+    if faltan.any():
+        dni, estado = codificar_dni(df.loc[faltan, 'DNI_Categorizado'])
+        df['dni'] = df['dni'].astype('Int64')
+        df['dni_estado'] = pd.Categorical(df['dni_estado'], categories=ESTADOS_DNI)
+        df.loc[faltan, 'dni'] = dni
+        df.loc[faltan, 'dni_estado'] = estado
     return df
 
+def clave_dni(df):
+    """Clave entera por fila para dedup/joins: el DNI o CLAVE_DNI_EXTRANJERO (NA = no brindó)."""
+    return df['dni'].mask((df['dni_estado'] == ESTADO_DNI_EXTRANJERO).to_numpy(bool), CLAVE_DNI_EXTRANJERO)
+
 # --- CATEGORIZACIÓN ---
 CATEGORIAS_BRINDA_DATOS = ["traslado efectivo a cis", "acepta cis pero no hay vacante", "se activa protocolo de salud mental", "derivacion a same", "traslado/acompanamiento a otros efectores", "mendicidad (menores de edad)"]
 CATEGORIAS_NO_BRINDA_DATOS = ["se realiza entrevista", "rechaza entrevista y se retira del lugar", "imposibilidad de abordaje por consumo", "rechaza entrevista y se queda en el lugar", "derivacion a espacio publico", "no se encuentra en situacion de calle"]
@@ -215,14 +676,85 @@ PATRONES_PERSONALIZADOS = {
     "desestimado": "desestimado (cartas 911 u otras areas)"
 }
 
-def mapear_categoria_con_reglas(texto):
-    if texto in PATRONES_EXACTOS: return PATRONES_EXACTOS[texto]
-    for patron, categoria in PATRONES_PERSONALIZADOS.items():
-        if patron in texto: return categoria
-    
-    # Fuzzy match
-    mejor_match, score, _ = process.extractOne(texto, CATEGORIAS_TODAS, scorer=fuzz.WRatio)
-    return mejor_match if score >= 80 else "sin_match"
+# Con pocas reglas recorrerlas con 'in' es más rápido que la regex compilada (ver
+# benchmark_patrones.py: con las 15 reglas actuales el trie es ~2x más lento, empata entre
+# 30 y 50 y gana con margen desde ~100). Desde este umbral se compila.
+UMBRAL_REGLAS_COMPILADAS = 100
+
+class ComparadorPatrones:
+    """
+    Substrings con prioridad. Devuelve la categoría del primer patrón del dict (en orden)
+    que aparece en el texto, igual que recorrerlos con 'in'.
+    compilar: None = automático (desde UMBRAL_REGLAS_COMPILADAS reglas), True/False fuerza.
+    Compilado, los patrones forman un trie dentro de un lookahead: findall prueba cada
+    posición (incluye matches superpuestos) bajando carácter a carácter por el trie, sin
+    probar patrón por patrón, y en cada posición devuelve el patrón más largo que empieza
+    ahí. Para cada patrón se precalcula la mejor prioridad entre él y sus prefijos que
+    también son patrones (los demás que matchean en esa posición).
+    """
+
+    def __init__(self, patrones, compilar=None):
+        self.patrones = list(patrones.items())
+        self.categorias = list(patrones.values())
+        self.compilado = len(self.patrones) >= UMBRAL_REGLAS_COMPILADAS if compilar is None else compilar
+        if not self.compilado:
+            return
+        trie = {}
+        for prioridad, patron in enumerate(patrones):
+            nodo = trie
+            for c in patron:
+                nodo = nodo.setdefault(c, {})
+            nodo[None] = prioridad  # None marca fin de patrón
+        self._mejor_prioridad = {}
+        alternativas = self._compilar(trie, '', len(self.categorias))
+        self.regex = re.compile(f'(?=({alternativas}))')
+        # Sin lookahead re saltea por primer carácter: descarta rápido los textos sin match
+        self.alguno = re.compile(alternativas)
+
+    def _compilar(self, nodo, prefijo, mejor):
+        alternativas = []
+        for c in sorted(k for k in nodo if k is not None):
+            hijo, literal = nodo[c], c
+            # Las cadenas de nodos con un solo hijo van como un literal
+            while None not in hijo and len(hijo) == 1:
+                (c, hijo), = hijo.items()
+                literal += c
+            camino, mejor_hijo = prefijo + literal, mejor
+            if None in hijo:
+                mejor_hijo = min(mejor, hijo[None])
+                self._mejor_prioridad[camino] = mejor_hijo
+            regex = re.escape(literal)
+            if len(hijo) > (None in hijo):
+                regex += f'(?:{self._compilar(hijo, camino, mejor_hijo)})' + ('?' if None in hijo else '')
+            alternativas.append(regex)
+        return '|'.join(alternativas)
+
+    def _mejor(self, texto):
+        return self.categorias[min(map(self._mejor_prioridad.__getitem__, self.regex.findall(texto)))]
+
+    def _primero(self, texto):
+        for patron, categoria in self.patrones:
+            if patron in texto: return categoria
+        return None
+
+    def categorizar(self, textos):
+        """
+        Versión por columna (None si ningún patrón aparece), una vez por texto distinto.
+        Compilado, los textos distintos se filtran de una con str.contains (RE2 sobre el
+        string de pyarrow, sin lookahead) y solo los que tienen algún match pasan a buscar
+        la prioridad.
+        """
+        codigos, unicos = pd.factorize(textos)
+        if not self.compilado:
+            categorias = np.array([self._primero(t) for t in unicos] + [None], dtype=object)
+            return pd.Series(categorias[codigos], index=textos.index, dtype=object)
+        unicos = pd.Series(unicos, dtype='str')
+        con_match = unicos.str.contains(self.alguno.pattern, regex=True).to_numpy(dtype=bool)
+        categorias = np.full(len(unicos) + 1, None, dtype=object)
+        categorias[np.flatnonzero(con_match)] = [self._mejor(t) for t in unicos[con_match]]
+        return pd.Series(categorias[codigos], index=textos.index, dtype=object)
+
+COMPARADOR_PERSONALIZADOS = ComparadorPatrones(PATRONES_PERSONALIZADOS)
 
 def obtener_niveles(cat):
     if cat in CATEGORIAS_BRINDA_DATOS: return "Contacta", "Brinda datos"
@@ -230,181 +762,194 @@ def obtener_niveles(cat):
     elif cat in CATEGORIAS_NO_CONTACTA: return "No se contacta", ""
     else: return "Derivaciones/seguimientos", ""
 
+# --- SERVICIO DE CATEGORIZACIÓN (TEXTOS DISTINTOS + CACHE PERSISTIDA) ---
+# Reglas, en orden: PATRONES_EXACTOS -> PATRONES_PERSONALIZADOS (substring, la primera
+# que matchea) -> fuzzy WRatio contra CATEGORIAS_TODAS (>= 80, si no "sin_match").
+# Cada texto_limpio distinto se resuelve una sola vez, los que caen al fuzzy match se
+# resuelven juntos con process.cdist (todos los cores) y el resultado queda en una cache
+# texto_limpio -> categoria_final versionada por un hash de las tablas de reglas.
+PUNTAJE_MINIMO_FUZZY = 80
+NOMBRE_CACHE_CATEGORIAS = "categorias_cache.parquet"
+
+def version_reglas_categorizacion():
+    """Hash de todo lo que define la categoría de un texto: si cambia, la cache se descarta."""
+    reglas = {
+        'exactos': PATRONES_EXACTOS,
+        'personalizados': list(PATRONES_PERSONALIZADOS.items()),  # el orden importa
+        'categorias': CATEGORIAS_TODAS,
+        'fuzzy': ['WRatio', PUNTAJE_MINIMO_FUZZY],
+    }
+    return hashlib.sha256(json.dumps(reglas, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()
+
+class CategorizadorCierres:
+    """Resuelve categoria_final por texto distinto, con cache en memoria (persistible)."""
+
+    def __init__(self, version, cache=None):
+        self.version = version
+        self.cache = dict(cache or {})
+        self.nuevas = 0
+
+    def _resolver(self, textos):
+        """Reglas para textos que no están en cache: exacto -> substring -> fuzzy (en bloque)."""
+        resultado = [PATRONES_EXACTOS.get(texto) for texto in textos]
+        sin_exacto = [i for i, categoria in enumerate(resultado) if categoria is None]
+        substrings = COMPARADOR_PERSONALIZADOS.categorizar(pd.Series([textos[i] for i in sin_exacto], dtype='str'))
+        pendientes = []
+        for i, categoria in zip(sin_exacto, substrings):
+            resultado[i] = categoria
+            if categoria is None:
+                pendientes.append(i)
+
+        if pendientes:
+            # dtype float64: mismos puntajes que extractOne (el default float32 redondea cerca de 80).
+            # argmax devuelve el primer máximo, igual que extractOne ante empates.
+            puntajes = process.cdist([textos[i] for i in pendientes], CATEGORIAS_TODAS,
+                                     scorer=fuzz.WRatio, dtype=np.float64, workers=-1)
+            mejores = puntajes.argmax(axis=1)
+            for i, mejor, puntaje in zip(pendientes, mejores, puntajes[np.arange(len(pendientes)), mejores]):
+                resultado[i] = CATEGORIAS_TODAS[mejor] if puntaje >= PUNTAJE_MINIMO_FUZZY else "sin_match"
+            print(f"🔎 Fuzzy match en bloque: {len(pendientes)} textos.")
+        return resultado
+
+    def categorizar(self, textos):
+        """textos: Series de texto_limpio. Devuelve la Series de categoria_final alineada."""
+        codigos, unicos = pd.factorize(textos)
+        unicos = list(unicos)
+        faltantes = [t for t in unicos if t not in self.cache]
+        if faltantes:
+            self.cache.update(zip(faltantes, self._resolver(faltantes)))
+            self.nuevas += len(faltantes)
+        print(f"🧠 Categorización: {len(unicos)} textos distintos, {len(faltantes)} sin cache.")
+        categorias = np.array([self.cache[t] for t in unicos] + [None], dtype=object)
+        return pd.Series(categorias[codigos], index=textos.index).infer_objects()
+
+    def tabla(self):
+        return pd.DataFrame({
+            'texto_limpio': list(self.cache.keys()),
+            'categoria_final': list(self.cache.values()),
+            'version_reglas': self.version,
+        })
+
 # ==========================================
-# LÓGICA PRINCIPAL DEL PROCESO
+# INGESTA DE EXCEL (MOTOR RÁPIDO + CACHE DE HOJAS PARSEADAS)
 # ==========================================
 
-def procesar_datos(excel_content_bytes, folder_id):
-    service = get_drive_service()
-    
-    # ---------------------------------------------------------
-    # FASE 1: ACTUALIZACIÓN DEL CRUDO (APPEND)
-    # ---------------------------------------------------------
-    print("🚀 Iniciando Fase 1: Actualización del Crudo...")
-    
-    df_nuevo = pd.read_excel(io.BytesIO(excel_content_bytes), skiprows=1)
-    nombre_crudo = "2025_historico_v2.parquet"
-    df_hist = download_parquet_as_df(service, nombre_crudo, folder_id)
+# calamine (Rust) parsea .xls/.xlsx varias veces más rápido que openpyxl/xlrd.
+# Se puede forzar otro motor con BAP_EXCEL_ENGINE=openpyxl (o xlrd).
+# Única diferencia observada: calamine lee celdas con solo espacios como vacías (NaN).
+try:
+    import python_calamine  # noqa: F401
+    MOTOR_EXCEL_DEFAULT = 'calamine'
+except ImportError:
+    MOTOR_EXCEL_DEFAULT = None  # pandas elige openpyxl/xlrd según la extensión
+MOTOR_EXCEL = os.getenv('BAP_EXCEL_ENGINE') or MOTOR_EXCEL_DEFAULT
+
+# Hojas ya parseadas, por file id + md5 de Drive + motor. Subir VERSION_PARSEO si cambia
+# leer_excel_insumo. Mismo límite LRU que la cache de Drive (BAP_CACHE_MAX_MB).
+DIRECTORIO_EXCEL_PARSEADO = os.path.join(os.path.dirname(CACHE_DRIVE.directorio), 'excel_parseado')
+CACHE_EXCEL_PARSEADO = CacheDrive(directorio=DIRECTORIO_EXCEL_PARSEADO)
+VERSION_PARSEO = 2
+
+def leer_excel_insumo(excel_content_bytes, engine=None):
+    """Parsea un Excel semanal de 01_insumos y normaliza fechas y coordenadas."""
+    df_nuevo = pd.read_excel(io.BytesIO(excel_content_bytes), skiprows=1, engine=engine or MOTOR_EXCEL)
 
     # Normalización de Fechas
-    col_fecha = 'Fecha Inicio'
-    for df in [df_hist, df_nuevo]:
-        if not df.empty:
-            for col in [col_fecha, 'Fecha Fin', 'Recurso Fecha Liberado', 'Recurso Fecha asignacion', 'Recurso Arribo']:
-                if col in df.columns:
-                    df[col] = pd.to_datetime(df[col], errors='coerce')
+    normalizar_fechas_crudo(df_nuevo)
 
     # Normalización Lat/Lon
     for col in ['Latitud', 'Longitud']:
         df_nuevo[col] = df_nuevo[col].astype(str).str.replace(',', '.', regex=False).astype(float)
 
-    # Filtrado (Solo nuevos)
-    if not df_hist.empty:
-        fecha_corte = df_hist[col_fecha].max()
-        print(f"📅 Fecha de corte detectada: {fecha_corte}")
-        df_filtrado_nuevo = df_nuevo[df_nuevo[col_fecha] > fecha_corte]
-    else:
-        df_filtrado_nuevo = df_nuevo
-        print("📅 No hay histórico previo. Se procesará todo el Excel.")
-
-    # Concatenar y guardar
-    if not df_filtrado_nuevo.empty:
-        df_actualizado = pd.concat([df_hist, df_filtrado_nuevo], ignore_index=True)
-        upload_df_as_parquet(service, df_actualizado, nombre_crudo, folder_id)
-        print(f"✅ Se agregaron {len(df_filtrado_nuevo)} registros nuevos al crudo.")
-    else:
-        print("⚠️ No hay registros nuevos para agregar. Usando histórico existente.")
-        df_actualizado = df_hist
+    # Huellas por archivo: el n° de ocurrencia de id_fila se cuenta dentro de este Excel
+    return agregar_huellas(df_nuevo)
 
-    # Limpieza de memoria
-    del df_hist, df_nuevo, df_filtrado_nuevo
-    gc.collect()
+def _ruta_excel_parseado(archivo, engine=None):
+    motor = engine or MOTOR_EXCEL or 'auto'
+    return os.path.join(DIRECTORIO_EXCEL_PARSEADO, f"v{VERSION_PARSEO}_{motor}_{archivo['id']}_{archivo['md5Checksum']}.parquet")
+
+def leer_excel_drive(service, archivo, engine=None):
+    """
+    Punto único de ingesta de un Excel de Drive (archivo = metadata con id y md5Checksum).
+    Si esa versión del archivo ya se parseó (con el mismo motor), se lee el parquet cacheado
+    sin descargar ni parsear.
+    """
+    ruta = _ruta_excel_parseado(archivo, engine) if archivo.get('md5Checksum') and CACHE_EXCEL_PARSEADO.habilitada else None
+    if ruta and os.path.exists(ruta):
+        print(f"🗄️ Excel ya parseado: {archivo.get('name', archivo['id'])}")
+        os.utime(ruta)  # LRU: la fecha de modificación marca el último uso
+        return pd.read_parquet(ruta)
 
+    df = leer_excel_insumo(download_file_as_bytes(service, archivo['id'], metadata=archivo), engine=engine)
+    if ruta:
+        try:
+            os.makedirs(DIRECTORIO_EXCEL_PARSEADO, exist_ok=True)
+            df.to_parquet(f"{ruta}.tmp", index=False, engine='pyarrow')
+            os.replace(f"{ruta}.tmp", ruta)
+            CACHE_EXCEL_PARSEADO.evictar(proteger=ruta)
+        except Exception as e:
+            # Columnas con tipos mezclados no siempre se pueden serializar: solo se pierde la cache
+            print(f"⚠️ No se pudo cachear el Excel parseado ({type(e).__name__}): {e}")
+    return df
+
+# ==========================================
+# LÓGICA PRINCIPAL DEL PROCESO
+# ==========================================
+
+NOMBRE_LIMPIO = "2025_historico_limpio.parquet"
+# Huellas (id_fila + hash_contenido) de todas las filas del crudo que ya pasaron por Fase 2/3
+# (incluye las que luego se descartan por agencia o por el dedup semanal, para no
+# re-enriquecerlas cada día)
+NOMBRE_IDS_PROCESADOS = "2025_historico_limpio_ids.parquet"
+
+def descargar_limpio(service, folder_id, columns=None):
+    """Lee el histórico limpio de Drive con los dtypes de esquema_limpio (vacío si no existe)."""
+    return aplicar_esquema(completar_dni(download_parquet_as_df(service, NOMBRE_LIMPIO, folder_id, columns=columns)))
+
+def semana_inicio(fechas):
+    """Inicio (lunes) de la semana W-SUN de cada fecha, igual que la columna 'Semana' del tablero."""
+    return fechas.dt.to_period('W-SUN').dt.start_time
+
+def enriquecer_comunas(df_actualizado, clasificador=None, memo=None, paralelo=False):
+    """
+    FASE 2: asigna comuna_calculada (1-15, 2.5 Anillo Digital C2, 14.5 Palermo Norte).
+    Con memo (MemoComunas) solo las coordenadas nunca vistas van al índice espacial.
+    paralelo: reparte la clasificación entre procesos (reconstrucciones completas).
+    """
     # ---------------------------------------------------------
     # FASE 2: ENRIQUECIMIENTO GEOGRÁFICO (COMUNAS)
     # ---------------------------------------------------------
     print("🌍 Iniciando Fase 2: Spatial Join con Comunas...")
-    
-    # --- PASO 1: CLASIFICACIÓN DE ZONAS ESPECIALES (KMZ) ---
-    # Inicializar comuna_calculada como None
-    df_actualizado['comuna_calculada'] = None
-    
-    # Habilitar soporte KML en fiona
-    fiona.drvsupport.supported_drivers['KML'] = 'rw'
-    fiona.drvsupport.supported_drivers['LIBKML'] = 'rw'
-    
-    # Convertir DataFrame a GeoDataFrame (una sola vez)
-    df_actualizado['geometry'] = df_actualizado.apply(lambda row: Point(row['Longitud'], row['Latitud']), axis=1)
-    puntos_gdf = gpd.GeoDataFrame(df_actualizado, crs="EPSG:4326")
-    
-    # PASO 1: Palermo Norte (Comuna 14.5) - PRIMERO
-    print("📍 PASO 1: Clasificando puntos dentro de Palermo Norte...")
-    ruta_palermo_norte = os.path.join(os.path.dirname(__file__), 'assets', 'comunas', 'Palermo_Norte.kmz')
-    
-    if not os.path.exists(ruta_palermo_norte):
-        raise FileNotFoundError(f"❌ No encuentro el archivo KMZ en: {ruta_palermo_norte}")
-    
-    with zipfile.ZipFile(ruta_palermo_norte, 'r') as kmz:
-        kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-        if not kml_files:
-            raise FileNotFoundError(f"❌ No se encontró archivo KML dentro del KMZ: {ruta_palermo_norte}")
-        
-        with kmz.open(kml_files[0]) as kml_file:
-            gdf_palermo_norte = gpd.read_file(kml_file)
-    
-    # Asegurar mismo CRS
-    if puntos_gdf.crs != gdf_palermo_norte.crs:
-        gdf_palermo_norte = gdf_palermo_norte.to_crs(puntos_gdf.crs)
-    
-    # Spatial Join con Palermo Norte
-    resultado_palermo = gpd.sjoin(puntos_gdf, gdf_palermo_norte[['geometry']], how="left", predicate="within")
-    
-    # Identificar puntos dentro de Palermo Norte
-    mask_palermo = resultado_palermo['index_right'].notna()
-    
-    # Asignar 14.5 (código para Palermo Norte) a los puntos que caen dentro
-    df_actualizado.loc[mask_palermo, 'comuna_calculada'] = 14.5
-    
-    print(f"✅ Puntos clasificados como Palermo Norte (14.5): {mask_palermo.sum()}")
-    
-    del resultado_palermo, gdf_palermo_norte
-    gc.collect()
-    
-    # PASO 2: Anillo Digital C2 (Comuna 2.5) - SEGUNDO
-    print("📍 PASO 2: Clasificando puntos dentro de Anillo Digital C2...")
-    ruta_anillo_c2 = os.path.join(os.path.dirname(__file__), 'assets', 'comunas', 'anillo_digital_c2.kmz')
-    
-    if os.path.exists(ruta_anillo_c2):
-        with zipfile.ZipFile(ruta_anillo_c2, 'r') as kmz:
-            kml_files = [f for f in kmz.namelist() if f.endswith('.kml')]
-            if kml_files:
-                with kmz.open(kml_files[0]) as kml_file:
-                    gdf_anillo_c2 = gpd.read_file(kml_file)
-                
-                # Asegurar mismo CRS
-                if puntos_gdf.crs != gdf_anillo_c2.crs:
-                    gdf_anillo_c2 = gdf_anillo_c2.to_crs(puntos_gdf.crs)
-                
-                # Spatial Join
-                resultado_anillo = gpd.sjoin(puntos_gdf, gdf_anillo_c2[['geometry']], how="left", predicate="within")
-                mask_anillo = resultado_anillo['index_right'].notna()
-                
-                # Asignar 2.5 (código para Anillo Digital C2)
-                df_actualizado.loc[mask_anillo, 'comuna_calculada'] = 2.5
-                print(f"✅ Puntos clasificados como Anillo Digital C2 (2.5): {mask_anillo.sum()}")
-                
-                del resultado_anillo, gdf_anillo_c2
+
+    # Palermo Norte, Anillo Digital C2 y comunas.shp en un único índice espacial
+    # (ver clasificador_zonas.py); las capas salen del artefacto compilado
+    if clasificador is None:
+        clasificador = obtener_clasificador()
+    if paralelo:
+        clasificador = ClasificadorParalelo(clasificador)
+
+    lon = df_actualizado['Longitud'].to_numpy(dtype='float64', na_value=np.nan)
+    lat = df_actualizado['Latitud'].to_numpy(dtype='float64', na_value=np.nan)
+    if memo is not None:
+        df_actualizado['comuna_calculada'] = memo.clasificar(clasificador, lon, lat)
     else:
-        print(f"⚠️ Archivo {ruta_anillo_c2} no encontrado - se omite Anillo Digital C2")
-        mask_anillo = pd.Series([False] * len(df_actualizado))
-    
-    gc.collect()
-    
-    # PASO 3: CLASIFICACIÓN DE COMUNAS (SHP) - TERCERO
-    # IMPORTANTE: Solo clasificar puntos que AÚN NO tienen comuna asignada
-    print("📍 PASO 3: Ejecutando cruce espacial con comunas para puntos sin clasificar...")
-    
-    # Ruta dinámica al shapefile (assets dentro del src)
-    ruta_shp = os.path.join(os.path.dirname(__file__), 'assets', 'comunas', 'comunas.shp')
-    
-    if not os.path.exists(ruta_shp):
-        raise FileNotFoundError(f"❌ No encuentro el shapefile en: {ruta_shp}")
+        df_actualizado['comuna_calculada'] = clasificador.clasificar(lon, lat)
 
-    gdf_comunas = gpd.read_file(ruta_shp)
-    
-    # Asegurar mismo CRS
-    if puntos_gdf.crs != gdf_comunas.crs:
-        gdf_comunas = gdf_comunas.to_crs(puntos_gdf.crs)
-
-    # CRÍTICO: Solo procesar puntos donde comuna_calculada es None
-    # Esto preserva las clasificaciones de Palermo Norte (14.5) y Anillo Digital (2.5)
-    mask_sin_clasificar = df_actualizado['comuna_calculada'].isna()
-    puntos_sin_clasificar_gdf = puntos_gdf[mask_sin_clasificar].copy()
-    
-    print(f"📊 Puntos sin clasificar que irán al SHP: {mask_sin_clasificar.sum()}")
-    
-    if len(puntos_sin_clasificar_gdf) > 0:
-        resultado_sjoin = gpd.sjoin(puntos_sin_clasificar_gdf, gdf_comunas[['comuna', 'geometry']], how="left", predicate="within")
-        
-        # Asignar comunas SOLO a los puntos que no tenían clasificación
-        df_actualizado.loc[mask_sin_clasificar, 'comuna_calculada'] = resultado_sjoin['comuna'].values
-        
-        del resultado_sjoin
-    
-    # Limpiar geometría
-    df_actualizado = df_actualizado.drop(columns=['geometry'])
-    
     # Verificar distribución final
     print(f"✅ Distribución final de comuna_calculada:")
     print(f"   - Palermo Norte (14.5): {(df_actualizado['comuna_calculada'] == 14.5).sum()}")
     print(f"   - Anillo Digital C2 (2.5): {(df_actualizado['comuna_calculada'] == 2.5).sum()}")
     print(f"   - Comunas regulares: {df_actualizado['comuna_calculada'].between(1, 15, inclusive='both').sum()}")
-    
+    print(f"   - Sin zona: {df_actualizado['comuna_calculada'].isna().sum()}")
+
     # comuna_calculada queda como float (comunas 1.0-15.0, zonas especiales: 2.5, 14.5)
-    
-    del puntos_gdf, puntos_sin_clasificar_gdf, gdf_comunas
-    gc.collect()
+    return df_actualizado
 
+def limpiar_y_categorizar(df_actualizado, categorizador=None):
+    """
+    FASE 3: limpieza de DNI y nombres, filtro de agencias y categorización de cierres.
+    categorizador: CategorizadorCierres (con la cache persistida); si no, uno vacío.
+    """
     # ---------------------------------------------------------
     # FASE 3: LIMPIEZA Y CATEGORIZACIÓN (CLEAN)
     # ---------------------------------------------------------
@@ -413,10 +958,11 @@ def procesar_datos(excel_content_bytes, folder_id):
     # 1. Limpieza DNI
     df_actualizado = limpiar_y_categorizar_dni_v3(df_actualizado, 'Persona DNI', columna_salida='DNI_Categorizado')
     df_actualizado['DNI_Categorizado'] = df_actualizado['DNI_Categorizado'].astype(str)
+    df_actualizado['dni'], df_actualizado['dni_estado'] = codificar_dni(df_actualizado['DNI_Categorizado'])
 
     # 2. Limpieza Nombres
-    df_actualizado['Persona Nombre'] = df_actualizado['Persona Nombre'].apply(limpiar_texto)
-    df_actualizado['Persona Apellido'] = df_actualizado['Persona Apellido'].apply(limpiar_texto)
+    df_actualizado['Persona Nombre'] = normalizar_nombres(df_actualizado['Persona Nombre'])
+    df_actualizado['Persona Apellido'] = normalizar_nombres(df_actualizado['Persona Apellido'])
 
     # 3. Eliminar Agencias
     agencias_a_eliminar = ['DIPA I COMBATE', 'MAPA DE RIESGO - SEGUIMIENTO', 'MAPA DE REISGO - SEGUIMIENTO','DIPA II ZABALA', 'AREA OPERATIVA', 'SALUD MENTAL']
@@ -431,13 +977,88 @@ def procesar_datos(excel_content_bytes, folder_id):
     df_actualizado['texto_limpio'] = df_actualizado['cierre_texto'].apply(limpiar_texto_cierre)
     
     print("🧠 Aplicando reglas y Fuzzy Match...")
-    df_actualizado['categoria_final'] = df_actualizado['texto_limpio'].apply(mapear_categoria_con_reglas)
+    if categorizador is None:
+        categorizador = CategorizadorCierres(version_reglas_categorizacion())
+    df_actualizado['categoria_final'] = categorizador.categorizar(df_actualizado['texto_limpio'])
 
     # 5. Niveles
     niveles = df_actualizado['categoria_final'].apply(lambda x: obtener_niveles(x))
     df_actualizado['contacto'] = niveles.apply(lambda x: x[0])
     df_actualizado['brinda_datos'] = niveles.apply(lambda x: x[1])
 
+    return df_actualizado
+
+class EstadoEvolucionDNI:
+    """
+    Lo que arrastra la clasificación de Tipo_Evolucion de una semana a la siguiente: por DNI
+    (dni_clave, ver clave_dni) su última comuna (ultima_comuna) y si ya fue visto, al comenzar
+    la semana semana_corte. semana_corte None = estado vacío (antes de la primera semana).
+    """
+
+    COLUMNAS = ['ultima_comuna', 'primera_semana', 'ultima_semana', 'semanas_vistas']
+
+    def __init__(self, semana_corte=None, tabla=None):
+        self.semana_corte = semana_corte
+        if tabla is None:
+            tabla = pd.DataFrame({c: [] for c in ['dni_clave'] + self.COLUMNAS})
+        self.dnis = tabla.set_index('dni_clave')[self.COLUMNAS]
+
+    def clasificar(self, df_sem):
+        """
+        Nuevos / Recurrentes / Migratorios de df_sem (un registro por Semana + DNI, en orden
+        cronológico, todas las semanas >= semana_corte). Dentro de cada DNI la fila anterior
+        es su semana anterior; para la primera se usa el estado.
+        """
+        por_dni = df_sem.groupby('dni_clave', sort=False, dropna=False)
+        primera = por_dni.cumcount().to_numpy() == 0
+        en_estado = df_sem['dni_clave'].isin(self.dnis.index).to_numpy()
+        ya_visto = ~primera | en_estado
+        comuna_previa = por_dni['comuna_calculada'].shift()
+        if not self.dnis.empty:
+            comuna_previa = comuna_previa.where(~primera, df_sem['dni_clave'].map(self.dnis['ultima_comuna']))
+        # NaN/None no matchean: una comuna previa vacía cuenta como Migratorio
+        misma_comuna = (comuna_previa == df_sem['comuna_calculada']).to_numpy(dtype=bool, na_value=False)
+
+        # Nuevo: primera vez que vemos el DNI. Recurrente: su última comuna era esta misma.
+        # Migratorio: viene de otra comuna (o sin comuna registrada).
+        return np.select([~ya_visto, misma_comuna], ['Nuevos', 'Recurrentes'], default='Migratorios').astype(object)
+
+    def avanzar(self, df_sem, semana_corte):
+        """Incorpora las semanas de df_sem en [semana_corte actual, semana_corte nueva)."""
+        semanas = df_sem['Semana']
+        tramo = semanas < semana_corte
+        if self.semana_corte is not None:
+            tramo &= semanas >= self.semana_corte
+        tramo = df_sem.loc[tramo, ['dni_clave', 'Semana', 'comuna_calculada']]
+        nuevos = tramo.groupby('dni_clave', sort=False, dropna=False).agg(
+            primera_semana=('Semana', 'min'), ultima_semana=('Semana', 'max'), semanas_vistas=('Semana', 'size')
+        )
+        nuevos['ultima_comuna'] = tramo.drop_duplicates('dni_clave', keep='last') \
+            .set_index('dni_clave')['comuna_calculada']
+
+        todos = nuevos[self.COLUMNAS] if self.dnis.empty else pd.concat([self.dnis, nuevos[self.COLUMNAS]])
+        por_dni = todos.groupby(level=0, sort=False, dropna=False)
+        self.dnis = por_dni.agg(
+            primera_semana=('primera_semana', 'min'), ultima_semana=('ultima_semana', 'max'),
+            semanas_vistas=('semanas_vistas', 'sum')
+        )
+        # La última comuna es la del tramo más reciente aunque sea NaN (sin zona)
+        self.dnis.insert(0, 'ultima_comuna', todos['ultima_comuna'][~todos.index.duplicated(keep='last')])
+        self.dnis.index.name = 'dni_clave'
+        self.semana_corte = semana_corte
+
+    def tabla(self):
+        tabla = self.dnis.reset_index()
+        tabla['semana_corte'] = self.semana_corte
+        return tabla
+
+def calcular_evolucion_dni(df_actualizado, estado=None):
+    """
+    Clasifica cada DNI por semana como Nuevos / Recurrentes / Migratorios (columna Tipo_Evolucion).
+    estado: EstadoEvolucionDNI del limpio anterior. Con él solo se clasifican las semanas
+    >= estado.semana_corte (las anteriores conservan su Tipo_Evolucion); sin él se recorre
+    todo el histórico. Devuelve (df, estado al inicio de la última semana).
+    """
     # === INICIO BLOQUE EVOLUCIÓN DNI (Exact dashboardgenerator replication) ===
     print("🧠 Calculando evolución histórica de DNI (Python) - Lógica dashboardgenerator exacta...")
     
@@ -445,72 +1066,45 @@ def procesar_datos(excel_content_bytes, folder_id):
     df_actualizado = df_actualizado.sort_values('Fecha Inicio').reset_index(drop=True)
     
     # 2. Crear columna de Semana (mismo formato que dashboardgenerator)
-    df_actualizado['Semana'] = df_actualizado['Fecha Inicio'].dt.to_period("W-SUN").apply(lambda r: r.start_time)
+    df_actualizado['Semana'] = semana_inicio(df_actualizado['Fecha Inicio'])
     
-    # 3. Definir anónimos (no se clasifican)
-    anonimos = ['NO BRINDO/NO VISIBLE', 'NO BRINDO', 'NO VISIBLE', 'S/D']
+    # 3. Clave entera de DNI (anónimos = no brindó, NA: no se clasifican)
+    df_actualizado['dni_clave'] = clave_dni(completar_dni(df_actualizado))
     
     # 4. Drop duplicates por Semana + DNI SOLAMENTE (NO por comuna)
     print("🔄 Eliminando duplicados semanales (Semana + DNI)...")
     
     # Guardar anónimos aparte (no se deduplicean)
-    mask_anonimos = df_actualizado['DNI_Categorizado'].isin(anonimos)
+    mask_anonimos = df_actualizado['dni_clave'].isna()
     df_anonimos = df_actualizado[mask_anonimos].copy()
     df_no_anonimos = df_actualizado[~mask_anonimos].copy()
     
     # Eliminar duplicados SOLO en no-anónimos
     df_sem = df_no_anonimos.drop_duplicates(
-        subset=['Semana', 'DNI_Categorizado'], 
+        subset=['Semana', 'dni_clave'], 
         keep='last'  # Mantener el ÚLTIMO registro de cada DNI por semana
     ).copy()
     
     registros_eliminados = len(df_no_anonimos) - len(df_sem)
     print(f"📊 Eliminados {registros_eliminados} registros duplicados (keep='last')")
     
-    # 5. CLASIFICACIÓN ITERATIVA POR SEMANA (matching dashboardgenerator)
-    print("🔄 Clasificando DNIs semana por semana...")
-    
-    semanas = sorted(df_sem['Semana'].unique())
-    dni_last_comuna = {}  # Diccionario: DNI -> última comuna vista
-    dni_seen = set()      # Set de todos los DNIs que hemos visto
-    
-    # Lista para almacenar resultados de clasificación
-    clasificaciones = []
-    
-    for semana in semanas:
-        rows_sem = df_sem[df_sem['Semana'] == semana]
-        
-        # Para cada registro de esta semana, clasificarlo
-        for idx, row in rows_sem.iterrows():
-            dni = row['DNI_Categorizado']
-            comuna_actual = row['comuna_calculada']
-            
-            prior_comuna = dni_last_comuna.get(dni, None)
-            
-            # LÓGICA DE CLASIFICACIÓN (exacta de dashboardgenerator):
-            if prior_comuna is None and dni not in dni_seen:
-                # Nuevo: primera vez que vemos este DNI
-                clasificacion = 'Nuevos'
-            else:
-                # Ya fue visto
-                if prior_comuna is not None and prior_comuna == comuna_actual:
-                    # Recurrente: su última comuna era esta misma
-                    clasificacion = 'Recurrentes'
-                else:
-                    # Migratorio: viene de otra comuna (o caso borde)
-                    clasificacion = 'Migratorios'
-            
-            clasificaciones.append((idx, clasificacion))
-        
-        # CRÍTICO: Actualizar historial para TODOS los DNIs de esta semana
-        # (no solo los de la comuna que estamos analizando)
-        for idx, row in rows_sem.iterrows():
-            dni_last_comuna[row['DNI_Categorizado']] = row['comuna_calculada']
-            dni_seen.add(row['DNI_Categorizado'])
-    
-    # 6. Aplicar clasificaciones al DataFrame
-    for idx, clasificacion in clasificaciones:
-        df_sem.at[idx, 'Tipo_Evolucion'] = clasificacion
+    # 5. CLASIFICACIÓN POR DNI (misma lógica que el recorrido semana por semana de dashboardgenerator)
+    # df_sem está en orden cronológico y cada DNI aparece una sola vez por semana (ver
+    # EstadoEvolucionDNI.clasificar). Con snapshot solo se clasifican las semanas >= corte.
+    if estado is None:
+        print("🔄 Clasificando DNIs de todo el histórico (vectorizado)...")
+        estado = EstadoEvolucionDNI()
+        df_sem['Tipo_Evolucion'] = estado.clasificar(df_sem)
+    else:
+        a_clasificar = (df_sem['Semana'] >= estado.semana_corte).to_numpy()
+        print(f"🔄 Clasificando DNIs desde la semana {estado.semana_corte:%Y-%m-%d} "
+              f"({a_clasificar.sum()} de {len(df_sem)} registros) con el snapshot de {len(estado.dnis)} DNIs...")
+        tipos = df_sem['Tipo_Evolucion'].to_numpy(dtype=object)
+        tipos[a_clasificar] = estado.clasificar(df_sem[a_clasificar])
+        df_sem['Tipo_Evolucion'] = tipos
+
+    # 6. Estado al comenzar la última semana (la que todavía puede recibir filas)
+    estado.avanzar(df_sem, df_actualizado['Semana'].max())
     
     # 7. Anónimos siempre son "No clasificable"
     df_anonimos['Tipo_Evolucion'] = 'No clasificable'
@@ -520,26 +1114,179 @@ def procesar_datos(excel_content_bytes, folder_id):
     df_actualizado = df_actualizado.sort_values('Fecha Inicio').reset_index(drop=True)
     
     # Limpieza de columnas temporales
-    df_actualizado.drop(columns=['Semana'], inplace=True, errors='ignore')
+    df_actualizado.drop(columns=['Semana', 'dni_clave'], inplace=True, errors='ignore')
     
     print(f"✅ Clasificación completada - Lógica EXACTA de dashboardgenerator replicada")
     # === FIN BLOQUE EVOLUCIÓN DNI ===
 
+    return df_actualizado, estado
+
+def seleccionar_pendientes(service, folder_id, manifiesto, indice, procesadas, df_upsert, col_fecha='Fecha Inicio'):
+    """
+    Filas del crudo a enriquecer en modo incremental, sin leer todo el histórico.
+    Pendientes = filas del índice de huellas que no están en 'procesadas' (o cambiaron de
+    hash). Salen de df_upsert (lo que esta corrida escribió en el crudo); solo si quedaron
+    pendientes de una corrida anterior cortada se lee el crudo completo para ubicarlas.
+    Una fila editada puede cambiar qué registro sobrevive al dedup semanal (Semana + DNI):
+    las semanas con filas editadas se reprocesan completas, leyendo solo esas particiones
+    (la semana ISO del crudo es la misma semana W-SUN de Semana: lunes a domingo).
+    """
+    mask_nuevas, mask_modificadas = detectar_nuevas_y_modificadas(indice, procesadas)
+    pendientes = indice.loc[mask_nuevas | mask_modificadas, 'id_fila']
+    modificadas = indice.loc[mask_modificadas, 'id_fila']
+
+    df_crudo = None
+    df_fuente = df_upsert
+    if not pendientes.isin(df_upsert['id_fila']).all():
+        print("⚠️ Hay filas del crudo sin procesar de una corrida anterior: se lee el crudo completo para ubicarlas.")
+        df_crudo = df_fuente = leer_historico_particionado(service, folder_id, manifiesto=manifiesto)
+
+    df_pendientes = df_fuente[df_fuente['id_fila'].isin(pendientes)]
+    claves = clave_semana_iso(df_pendientes[col_fecha])
+    claves_modificadas = claves[df_pendientes['id_fila'].isin(modificadas)].unique().tolist()
+    if df_crudo is not None:
+        df_semanas = df_crudo[clave_semana_iso(df_crudo[col_fecha]).isin(claves_modificadas)]
+    else:
+        df_semanas = leer_historico_particionado(service, folder_id, semanas=claves_modificadas, manifiesto=manifiesto)
+
+    df_actualizado = pd.concat([df_semanas, df_pendientes[~claves.isin(claves_modificadas)]], ignore_index=True)
+    print(f"➕ Modo incremental: {mask_nuevas.sum()} filas nuevas y {mask_modificadas.sum()} modificadas "
+          f"({len(df_actualizado)} a enriquecer de {len(indice)} en el crudo, {len(claves_modificadas)} semanas releídas).")
+    return df_actualizado
+
+def procesar_datos(excel_content_bytes, folder_id, full_rebuild=False):
+    """
+    excel_content_bytes: bytes de un Excel de 01_insumos, o un DataFrame ya parseado con
+    leer_excel_insumo (ej. varios Excel pendientes combinados por main.py en modo lote).
+    None: sin insumo, se reprocesa el crudo existente (main.py --full-rebuild sin Excel
+    pendientes).
+    full_rebuild: re-enriquece todo el histórico (usar cuando cambian las tablas de reglas
+    o los archivos de zonas). Por defecto Fase 2/3 corren solo sobre las filas nuevas.
+    """
+    service = get_drive_service()
+    
     # ---------------------------------------------------------
-    # GUARDADO FINAL (DRIVE Y BIGQUERY)
+    # FASE 1: ACTUALIZACIÓN DEL CRUDO (UPSERT POR HUELLAS)
     # ---------------------------------------------------------
-    nombre_limpio = "2025_historico_limpio.parquet"
-    
-    # 1. Subida original a Drive (Mantenemos tu lógica existente)
-    upload_df_as_parquet(service, df_actualizado, nombre_limpio, folder_id)
+    print("🚀 Iniciando Fase 1: Actualización del Crudo...")
     
-    # 2. Subida a BigQuery
+    col_fecha = 'Fecha Inicio'
+    if excel_content_bytes is None:
+        df_nuevo = pd.DataFrame({col_fecha: pd.Series(dtype='datetime64[us]'),
+                                 'id_fila': pd.Series(dtype='int64'), 'hash_contenido': pd.Series(dtype='int64')})
+    elif isinstance(excel_content_bytes, pd.DataFrame):
+        df_nuevo = excel_content_bytes
+    else:
+        df_nuevo = leer_excel_insumo(excel_content_bytes)
+    manifiesto = cargar_manifiesto_crudo(service, folder_id)
+
+    # Huellas: clave de negocio + hash de contenido (leer_excel_insumo las calcula por
+    # archivo). Una misma id_fila en varios Excel (solapados en modo lote) es la misma
+    # fila: queda la versión del más nuevo. Dentro de un Excel las id_fila son únicas.
+    if not set(COLUMNAS_HUELLA) <= set(df_nuevo.columns):
+        agregar_huellas(df_nuevo)
+    df_nuevo = df_nuevo.drop_duplicates('id_fila', keep='last')
+    indice = cargar_indice_huellas(service, folder_id, manifiesto)
+
+    # Anti-join contra el índice (sin escanear el histórico): nuevas + editadas
+    mask_nuevas, mask_modificadas = detectar_nuevas_y_modificadas(df_nuevo, indice)
+    df_upsert = df_nuevo[mask_nuevas | mask_modificadas]
+    print(f"🔑 Índice de huellas: {len(indice)} filas conocidas. Insumo: {mask_nuevas.sum()} nuevas, {mask_modificadas.sum()} modificadas.")
+
+    # Upsert solo en las particiones semanales afectadas
+    if not df_upsert.empty:
+        manifiesto = escribir_particiones_crudo(service, df_upsert, folder_id, manifiesto)
+        indice = actualizar_indice_huellas(service, indice, df_upsert, folder_id)
+        print(f"✅ Se agregaron {mask_nuevas.sum()} registros nuevos y se actualizaron {mask_modificadas.sum()} en el crudo.")
+    else:
+        print("⚠️ No hay registros nuevos ni modificados. Usando histórico existente.")
+
+    # Limpieza de memoria
+    del df_nuevo
+    gc.collect()
+
+    # ---------------------------------------------------------
+    # SELECCIÓN INCREMENTAL: solo se enriquecen filas no procesadas
+    # ---------------------------------------------------------
+    df_limpio_prev = pd.DataFrame()
+    if not full_rebuild:
+        df_ids_prev = download_parquet_as_df(service, NOMBRE_IDS_PROCESADOS, folder_id)
+        df_limpio_prev = descargar_limpio(service, folder_id)
+        ultima_semana_prev = semana_inicio(df_limpio_prev[col_fecha]).max() if col_fecha in df_limpio_prev.columns else None
+        if df_ids_prev.empty or df_limpio_prev.empty or not set(COLUMNAS_HUELLA) <= set(df_limpio_prev.columns) \
+                or not set(COLUMNAS_HUELLA) <= set(df_ids_prev.columns):
+            print("⚠️ No hay un limpio previo con huellas: se hace una reconstrucción completa.")
+            full_rebuild = True
+            df_limpio_prev = pd.DataFrame()
+
+    if full_rebuild:
+        df_actualizado = leer_historico_particionado(service, folder_id, manifiesto=manifiesto)
+        print(f"🔁 Reconstrucción completa: se procesan las {len(df_actualizado)} filas del crudo.")
+        df_ids_procesados = df_actualizado[COLUMNAS_HUELLA]
+    else:
+        procesadas = pd.concat([df_ids_prev[COLUMNAS_HUELLA], df_limpio_prev[COLUMNAS_HUELLA]]).drop_duplicates('id_fila', keep='last')
+        df_actualizado = seleccionar_pendientes(service, folder_id, manifiesto, indice, procesadas, df_upsert)
+        df_limpio_prev = df_limpio_prev[~df_limpio_prev['id_fila'].isin(df_actualizado['id_fila'])]
+        df_ids_procesados = pd.concat([procesadas, df_actualizado[COLUMNAS_HUELLA]], ignore_index=True) \
+            .drop_duplicates('id_fila', keep='last').reset_index(drop=True)
+        del df_ids_prev, procesadas
+
+    del df_upsert, indice
+    gc.collect()
+
+    # Semana desde la que cambia el limpio (la evolución de DNI de las posteriores también).
+    # None => BigQuery se recarga completo. Las filas sin Fecha Inicio no tienen semana:
+    # cargar_incremental las sube siempre (partición NULL).
+    hay_cambios = full_rebuild or not df_actualizado.empty
+    semana_desde = None if full_rebuild or df_actualizado.empty else semana_inicio(df_actualizado[col_fecha]).min()
+    if pd.isna(semana_desde):
+        semana_desde = None
+
+    if not df_actualizado.empty:
+        clasificador = obtener_clasificador()
+        memo = cargar_memo_comunas(service, folder_id, clasificador.checksum)
+        df_actualizado = enriquecer_comunas(df_actualizado, clasificador, memo, paralelo=full_rebuild)
+        guardar_memo_comunas(service, memo, folder_id)
+        categorizador = cargar_cache_categorias(service, folder_id)
+        df_actualizado = limpiar_y_categorizar(df_actualizado, categorizador)
+        guardar_cache_categorias(service, categorizador, folder_id)
+
+    if not df_limpio_prev.empty:
+        df_actualizado = pd.concat([df_limpio_prev, df_actualizado], ignore_index=True)
+        del df_limpio_prev
+        gc.collect()
+
+    # Snapshot de DNI: alcanza con clasificar desde su semana de corte si no cambió nada anterior
+    estado_dni = None
+    if not full_rebuild and 'Tipo_Evolucion' in df_actualizado.columns:
+        estado_dni = cargar_estado_dni(service, folder_id, ultima_semana_prev)
+        if estado_dni is not None and semana_desde is not None and semana_desde < estado_dni.semana_corte:
+            print(f"⚠️ Hay cambios anteriores a la semana {estado_dni.semana_corte:%Y-%m-%d} del snapshot de DNI: se recorre todo el histórico.")
+            estado_dni = None
+
+    df_actualizado, estado_dni = calcular_evolucion_dni(df_actualizado, estado_dni)
+    df_actualizado = aplicar_esquema(df_actualizado)
+
+    # ---------------------------------------------------------
+    # GUARDADO FINAL (DRIVE Y BIGQUERY)
+    # ---------------------------------------------------------
+    # 1. Subida a BigQuery. Va primero: si falla, el limpio y los ids de Drive quedan
+    #    como estaban y la próxima corrida vuelve a detectar (y subir) estas filas.
     PROJECT_ID = 'autom-bap-personas'   # Tu ID de proyecto
     DATASET_ID = 'tablero_operativo'    # Tu Dataset
     TABLE_ID = 'historico_limpio'       # Tu Tabla
     
-    upload_to_bigquery(df_actualizado, PROJECT_ID, DATASET_ID, TABLE_ID)
+    if hay_cambios:
+        upload_to_bigquery(df_actualizado, PROJECT_ID, DATASET_ID, TABLE_ID, semana_desde=semana_desde)
+    else:
+        print("✅ BigQuery ya está al día: no hay filas nuevas ni modificadas.")
+    
+    # 2. Subida original a Drive (Mantenemos tu lógica existente)
+    upload_df_as_parquet(service, df_actualizado, NOMBRE_LIMPIO, folder_id)
+    upload_df_as_parquet(service, df_ids_procesados, NOMBRE_IDS_PROCESADOS, folder_id)
+    guardar_estado_dni(service, estado_dni, folder_id)
     
+    print(f"🗄️ Cache Drive: {CACHE_DRIVE.resumen()}")
     print(f"🎉 Proceso Terminado. Limpio actualizado al día {df_actualizado[col_fecha].max()}")
     
     return df_actualizado
\ No newline at end of file
@@ -0,0 +1,158 @@
+import os
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+
+# ==========================================
+# CACHE LOCAL DE DESCARGAS DE DRIVE
+# ==========================================
+# Los blobs se guardan por contenido (md5Checksum de Drive) en disco.
+# Antes de descargar se consulta solo la metadata del archivo: si el md5 ya
+# está en cache se sirve localmente. Sirve entre corridas y entre scripts
+# (main.py -> dashboard_generator.py) mientras compartan el directorio.
+# Los misses se descargan en streaming directo a disco y los lectores reciben
+# una ruta (ej. para abrir parquets con memory_map) en lugar de un buffer.
+
+DIRECTORIO_CACHE_DEFAULT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.cache', 'drive')
+MAX_MB_DEFAULT = 1024
+CAMPOS_METADATA = 'id, md5Checksum, modifiedTime, size'
+
+class CacheDrive:
+    """Cache en disco direccionada por contenido, con evicción LRU por tamaño."""
+
+    def __init__(self, directorio=None, max_bytes=None, habilitada=True):
+        self.directorio = directorio or os.getenv('BAP_CACHE_DIR', DIRECTORIO_CACHE_DEFAULT)
+        if max_bytes is None:
+            max_bytes = int(float(os.getenv('BAP_CACHE_MAX_MB', MAX_MB_DEFAULT)) * 1024 * 1024)
+        self.max_bytes = max_bytes
+        self.habilitada = habilitada and os.getenv('BAP_CACHE_DRIVE', '1') != '0'
+        self.hits = 0
+        self.misses = 0
+        self.bytes_ahorrados = 0
+        self._lock = threading.Lock()
+
+    # --- Claves ---
+
+    @staticmethod
+    def clave(metadata):
+        """md5Checksum si Drive lo informa; si no (ej. Google Docs), file_id + modifiedTime."""
+        if metadata.get('md5Checksum'):
+            return metadata['md5Checksum']
+        base = f"{metadata['id']}|{metadata.get('modifiedTime', '')}"
+        return 'mt_' + hashlib.md5(base.encode('utf-8')).hexdigest()
+
+    def _ruta(self, clave):
+        return os.path.join(self.directorio, clave[:2], clave)
+
+    # --- Lectura / escritura ---
+
+    def ruta_si_existe(self, metadata):
+        """Devuelve la ruta local del blob si está en cache (y lo marca como usado), o None."""
+        if not self.habilitada:
+            return None
+        ruta = self._ruta(self.clave(metadata))
+        if not os.path.exists(ruta):
+            return None
+        os.utime(ruta)  # LRU: la fecha de modificación marca el último uso
+        return ruta
+
+    def _ruta_temporal(self, ruta):
+        return f"{ruta}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+    def guardar(self, metadata, contenido):
+        """Guarda un blob en cache. Si no hay md5 en la metadata se calcula del contenido."""
+        if not self.habilitada or len(contenido) > self.max_bytes:
+            return None
+        if not metadata.get('md5Checksum'):
+            metadata = dict(metadata, md5Checksum=hashlib.md5(contenido).hexdigest())
+        ruta = self._ruta(self.clave(metadata))
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        tmp = self._ruta_temporal(ruta)
+        with open(tmp, 'wb') as f:
+            f.write(contenido)
+        os.replace(tmp, ruta)
+        self.evictar(proteger=ruta)
+        return ruta
+
+    def guardar_subida(self, contenido):
+        """Registra en cache un blob recién subido: Drive le asignará este mismo md5."""
+        return self.guardar({'id': None, 'md5Checksum': hashlib.md5(contenido).hexdigest()}, contenido)
+
+    @contextmanager
+    def abrir(self, service, file_id, descargar_a_archivo, metadata=None):
+        """
+        Context manager que entrega la ruta local de un archivo de Drive.
+        descargar_a_archivo(service, file_id, ruta) se llama solo ante un miss y escribe
+        directo a disco (sin pasar por memoria). Con la cache deshabilitada el archivo es
+        temporal y se borra al salir.
+        Si metadata no trae md5Checksum/modifiedTime se pide con una única llamada a files().get.
+        """
+        if not self.habilitada:
+            fd, tmp = tempfile.mkstemp(suffix='.drive')
+            os.close(fd)
+            try:
+                descargar_a_archivo(service, file_id, tmp)
+                yield tmp
+            finally:
+                os.remove(tmp)
+            return
+
+        if not metadata or not (metadata.get('md5Checksum') or metadata.get('modifiedTime')):
+            metadata = service.files().get(fileId=file_id, fields=CAMPOS_METADATA).execute()
+        metadata = dict(metadata, id=file_id)
+
+        ruta = self.ruta_si_existe(metadata)
+        if ruta is not None:
+            tamanio = os.path.getsize(ruta)
+            with self._lock:
+                self.hits += 1
+                self.bytes_ahorrados += tamanio
+            print(f"🗄️ Cache hit: {file_id} ({tamanio / 1024:.0f} KB servidos localmente)")
+        else:
+            with self._lock:
+                self.misses += 1
+            ruta = self._ruta(self.clave(metadata))
+            os.makedirs(os.path.dirname(ruta), exist_ok=True)
+            tmp = self._ruta_temporal(ruta)
+            try:
+                descargar_a_archivo(service, file_id, tmp)
+                os.replace(tmp, ruta)
+            finally:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+            self.evictar(proteger=ruta)
+        yield ruta
+
+    # --- Evicción LRU ---
+
+    def evictar(self, proteger=None):
+        """Elimina los blobs menos usados hasta quedar por debajo de max_bytes (salvo 'proteger')."""
+        entradas = []
+        for raiz, _, archivos in os.walk(self.directorio):
+            for nombre in archivos:
+                if nombre.endswith('.tmp'):
+                    continue
+                ruta = os.path.join(raiz, nombre)
+                try:
+                    st = os.stat(ruta)
+                except FileNotFoundError:
+                    continue
+                entradas.append((st.st_mtime, st.st_size, ruta))
+
+        total = sum(e[1] for e in entradas)
+        for _, tamanio, ruta in sorted(entradas):
+            if total <= self.max_bytes:
+                break
+            if ruta == proteger:
+                continue
+            try:
+                os.remove(ruta)
+                total -= tamanio
+            except FileNotFoundError:
+                pass
+
+    def resumen(self):
+        total = self.hits + self.misses
+        tasa = (self.hits / total * 100) if total else 0
+        return f"{self.hits} hits / {self.misses} misses ({tasa:.0f}%), {self.bytes_ahorrados / 1024 / 1024:.1f} MB sin descargar"
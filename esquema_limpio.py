@@ -0,0 +1,68 @@
+# ==========================================
+# ESQUEMA DEL HISTÓRICO LIMPIO (DTYPES CANÓNICOS)
+# ==========================================
+# dtype de cada columna de 2025_historico_limpio.parquet. Se aplica al final de
+# procesar_datos y en cada lectura del limpio (descargar_limpio), así el DataFrame en
+# memoria, el parquet y lo que reciben dashboard_generator / looker_reporter tienen
+# siempre los mismos tipos.
+#   category -> columnas de pocos valores distintos: un código entero por fila en memoria
+#               y columna diccionario en el parquet (las categorías se guardan en el archivo).
+#   str      -> texto libre o de muchos valores (string de pandas, NaN como faltante).
+#               Requiere pandas>=3: en pandas 2 astype('str') convierte NaN/None en 'nan'/'None'.
+#   float64  -> comuna_calculada (1-15, 2.5, 14.5; NaN = sin zona) y coordenadas.
+#   Int64    -> dni (entero nullable: NA si no brindó o es extranjero, ver dni_estado).
+# Todas las columnas del limpio tienen que figurar acá: las que no (ej. una columna nueva
+# del Excel) quedan como estén y aplicar_esquema las informa; bigquery_loader rechaza la
+# carga hasta que se declaren. Para agregar una columna al limpio, declararla acá y en
+# bigquery_loader.ESQUEMA_HISTORICO.
+
+CATEGORIA = 'category'
+TEXTO = 'str'
+
+ESQUEMA_LIMPIO = {
+    'Fecha Inicio': 'datetime64[us]',
+    'Fecha Fin': 'datetime64[us]',
+    'Recurso Fecha Liberado': 'datetime64[us]',
+    'Recurso Fecha asignacion': 'datetime64[us]',
+    'Recurso Arribo': 'datetime64[us]',
+    'Latitud': 'float64',
+    'Longitud': 'float64',
+    'Persona DNI': TEXTO,
+    'Persona Nombre': TEXTO,
+    'Persona Apellido': TEXTO,
+    'Agencia': CATEGORIA,
+    'Cierre Supervisor': TEXTO,
+    'Resultado': CATEGORIA,
+    'Estado': CATEGORIA,
+    'Tipo Carta': CATEGORIA,
+    'Observaciones': TEXTO,
+    'id_fila': 'int64',
+    'hash_contenido': 'int64',
+    'comuna_calculada': 'float64',
+    'DNI_Categorizado': TEXTO,
+    'DNI_Categorizado_motivo': CATEGORIA,
+    'dni': 'Int64',
+    'dni_estado': CATEGORIA,
+    'cierre_texto': TEXTO,
+    'texto_limpio': TEXTO,
+    'categoria_final': CATEGORIA,
+    'contacto': CATEGORIA,
+    'brinda_datos': CATEGORIA,
+    'Tipo_Evolucion': CATEGORIA,
+}
+
+def columnas_no_declaradas(df):
+    return [c for c in df.columns if c not in ESQUEMA_LIMPIO]
+
+def aplicar_esquema(df):
+    """
+    Devuelve df con cada columna conocida en su dtype canónico (solo castea las que difieren).
+    Las columnas que no están en ESQUEMA_LIMPIO se dejan como están y se informan.
+    """
+    no_declaradas = columnas_no_declaradas(df)
+    if no_declaradas:
+        print(f"⚠️ Columnas del limpio sin dtype en ESQUEMA_LIMPIO (se dejan como están): {no_declaradas}")
+    cambios = {c: t for c, t in ESQUEMA_LIMPIO.items() if c in df.columns and df[c].dtype != t}
+    if not cambios:
+        return df
+    return df.astype(cambios)
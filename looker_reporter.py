@@ -1,3 +1,4 @@
+import os
 import pandas as pd
 import numpy as np
 import gspread
@@ -17,7 +18,9 @@ def get_gspread_client():
         'https://www.googleapis.com/auth/spreadsheets',
         'https://www.googleapis.com/auth/drive'
     ]
-    creds = service_account.Credentials.from_service_account_file(KEY_FILE, scopes=scopes)
+    # Mismo criterio que data_processor.get_credentials: variable de entorno (GitHub Actions) > archivo local
+    creds_path = os.getenv('GOOGLE_APPLICATION_CREDENTIALS', KEY_FILE)
+    creds = service_account.Credentials.from_service_account_file(creds_path, scopes=scopes)
     return gspread.authorize(creds)
 
 def update_sheet(gc, sheet_id, worksheet_name, df):
@@ -1,71 +1,240 @@
 import os
 import sys
+import argparse
+import threading
+import datetime
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 # Asegúrate de importar las funciones correctamente
-from data_processor import get_drive_service, download_file_as_bytes, procesar_datos
+from data_processor import (
+    get_drive_service, procesar_datos, leer_excel_drive, download_json, upload_json,
+    descargar_limpio, hay_crudo, NOMBRE_LIMPIO
+)
+from dashboard_generator import generar_dashboard
+from looker_reporter import ejecutar_reportes_looker
 
 # --- CONFIGURACIÓN DE CARPETAS (IDs ACTUALIZADOS) ---
 
 # 1. CARPETA DE ENTRADA (01_insumos): Donde están tus .xls semanales
-INPUT_FOLDER_ID = '14kWGqDj-Q_TOl2-F9FqocI9H_SeL_6Ba' 
+INPUT_FOLDER_ID = '14kWGqDj-Q_TOl2-F9FqocI9H_SeL_6Ba'
 
 # 2. CARPETA DE BASE DE DATOS (02_base_datos): Donde vive el parquet y el histórico
 DB_FOLDER_ID = '1q7rGJjb3qCTNcyDUYzpn9v4JveLjsk6t'
 
-def main():
-    print("🏁 Iniciando proceso de captura...")
-    
-    # 1. Autenticación
-    try:
-        service = get_drive_service()
-    except Exception as e:
-        print(f"❌ Error de autenticación: {e}")
+# Manifiesto de Excel ya procesados (file id + md5), guardado en la carpeta DB
+NOMBRE_MANIFIESTO_INSUMOS = 'insumos_procesados.json'
+
+# Hilos para descargar/parsear Excel pendientes en modo lote
+MAX_WORKERS_LOTE = int(os.getenv('BAP_WORKERS_LOTE', 4))
+
+# CONSULTA CORREGIDA: Busca tanto formato nuevo (.xlsx) como viejo (.xls)
+QUERY_EXCELS = (
+    f"'{INPUT_FOLDER_ID}' in parents "
+    "and (mimeType = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' "
+    "or mimeType = 'application/vnd.ms-excel') "
+    "and trashed = false"
+)
+
+# =====================================================================
+# LISTADO Y MANIFIESTO DE INSUMOS
+# =====================================================================
+
+def listar_excels(service, solo_ultimo=False):
+    """Lista los Excel de 01_insumos (más reciente primero). Pagina si hace falta."""
+    campos = "nextPageToken, files(id, name, createdTime, md5Checksum, modifiedTime)"
+    if solo_ultimo:
+        results = service.files().list(q=QUERY_EXCELS, orderBy='createdTime desc', pageSize=1, fields=campos).execute()
+        return results.get('files', [])
+
+    files, page_token = [], None
+    while True:
+        results = service.files().list(
+            q=QUERY_EXCELS, orderBy='createdTime desc', pageSize=100,
+            fields=campos, pageToken=page_token
+        ).execute()
+        files.extend(results.get('files', []))
+        page_token = results.get('nextPageToken')
+        if not page_token:
+            return files
+
+def archivos_pendientes(files, manifiesto):
+    """Excel que no figuran en el manifiesto o cuyo contenido (md5) cambió desde que se procesaron."""
+    procesados = manifiesto.get('archivos', {})
+    return [f for f in files if procesados.get(f['id'], {}).get('md5Checksum') != f.get('md5Checksum')]
+
+def manifiesto_inicial(service, files):
+    """
+    Manifiesto para la primera corrida que lo usa. Si ya hay un crudo, los Excel que
+    estaban en 01_insumos se asumen ingestados (el proceso diario los fue cargando) y se
+    registran como procesados, salvo el más reciente: así el primer --lote no re-ingesta
+    todo lo subido históricamente. Sin crudo (carga inicial) quedan todos pendientes.
+    """
+    manifiesto = {'archivos': {}}
+    if len(files) > 1 and hay_crudo(service, DB_FOLDER_ID):
+        print(f"🗂️ Sin manifiesto de insumos: {len(files) - 1} Excel anteriores se registran como ya procesados.")
+        registrar_procesados(manifiesto, files[1:])
+    return manifiesto
+
+def registrar_procesados(manifiesto, files):
+    ahora = datetime.datetime.now().isoformat(timespec='seconds')
+    for f in files:
+        manifiesto.setdefault('archivos', {})[f['id']] = {
+            'name': f['name'],
+            'md5Checksum': f.get('md5Checksum'),
+            'procesado': ahora,
+        }
+    return manifiesto
+
+# =====================================================================
+# DESCARGA + PARSEO CONCURRENTE
+# =====================================================================
+
+# El cliente de googleapiclient no es thread-safe: un servicio por hilo
+_local = threading.local()
+
+def _servicio_del_hilo():
+    if not hasattr(_local, 'service'):
+        _local.service = get_drive_service()
+    return _local.service
+
+def descargar_y_parsear(archivo):
+    """Descarga un Excel de Drive y lo parsea (se ejecuta dentro del pool de hilos)."""
+    df = leer_excel_drive(_servicio_del_hilo(), archivo)
+    print(f"✅ {archivo['name']}: {len(df)} filas.")
+    return df
+
+def leer_pendientes(pendientes):
+    """Descarga y parsea en paralelo. Devuelve un único DataFrame (del más viejo al más nuevo)."""
+    pendientes = sorted(pendientes, key=lambda f: f['createdTime'])
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS_LOTE) as pool:
+        dfs = list(pool.map(descargar_y_parsear, pendientes))
+
+    # Los exportes semanales se solapan: procesar_datos deja una versión por id_fila
+    # (la del Excel más nuevo, que va último)
+    df_nuevo = pd.concat(dfs, ignore_index=True)
+    print(f"📊 {len(pendientes)} Excel combinados: {len(df_nuevo)} filas.")
+    return df_nuevo
+
+# =====================================================================
+# PUBLICACIÓN (HTML + GOOGLE SHEETS)
+# =====================================================================
+
+def publicar(service, df_limpio=None, sheets=True):
+    """
+    Publica el histórico limpio en el dashboard HTML y en las hojas de Looker.
+    Recibe el DataFrame que devolvió procesar_datos; solo si no hubo ingesta se
+    descarga una vez el limpio de Drive.
+    """
+    if df_limpio is None:
+        print(f"⬇️ Sin ingesta nueva: descargando {NOMBRE_LIMPIO} para publicar...")
+        df_limpio = descargar_limpio(service, DB_FOLDER_ID)
+    if df_limpio.empty:
+        print("⚠️ No hay histórico limpio para publicar.")
         return
 
-    # 2. Buscar el Excel más reciente en la CARPETA DE INSUMOS
+    # 5. Dashboard HTML
+    generar_dashboard(df_limpio)
+
+    # 6. Google Sheets (Looker). Un error acá no invalida lo ya publicado.
+    if sheets:
+        try:
+            ejecutar_reportes_looker(df_limpio)
+        except Exception as e:
+            print(f"❌ Error actualizando Google Sheets: {e}")
+
+# =====================================================================
+# FUNCIÓN PRINCIPAL
+# =====================================================================
+
+def reconstruir_sin_insumo(service):
+    """--full-rebuild sin Excel para procesar: reprocesa el histórico crudo que ya está en Drive."""
+    if not hay_crudo(service, DB_FOLDER_ID):
+        raise SystemExit("❌ --full-rebuild: no hay Excel para procesar ni histórico crudo en Drive que reconstruir.")
+    print("🔁 No hay Excel para procesar: --full-rebuild reprocesa el histórico crudo existente.")
+    df_limpio = procesar_datos(None, DB_FOLDER_ID, full_rebuild=True)
+    print("✅ Drive y BigQuery actualizados.")
+    return df_limpio
+
+def ingestar(service, lote=False, full_rebuild=False):
+    """
+    Pasos 2-4: busca los Excel, los procesa y devuelve el limpio (None si no hubo nada que
+    procesar). Con full_rebuild y sin Excel pendientes igual reconstruye desde el crudo.
+    """
+    # 2. Buscar Excel en la CARPETA DE INSUMOS (el más reciente, o todos los pendientes en modo lote)
     print(f"🔎 Buscando reportes (.xls / .xlsx) en: {INPUT_FOLDER_ID}...")
-    
-    # CONSULTA CORREGIDA: Busca tanto formato nuevo (.xlsx) como viejo (.xls)
-    query = (
-        f"'{INPUT_FOLDER_ID}' in parents "
-        "and (mimeType = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet' "
-        "or mimeType = 'application/vnd.ms-excel') "
-        "and trashed = false"
-    )
-    
-    results = service.files().list(
-        q=query, 
-        orderBy='createdTime desc', 
-        pageSize=1, 
-        fields="files(id, name, createdTime)"
-    ).execute()
-    
-    files = results.get('files', [])
+    files = listar_excels(service, solo_ultimo=not lote)
 
     if not files:
         print("⚠️ No se encontró ningún archivo Excel en '01_insumos'.")
         print("   -> Verifica que los archivos no estén en la papelera.")
-        return
+        return reconstruir_sin_insumo(service) if full_rebuild else None
 
-    archivo_excel = files[0]
-    print(f"📄 Archivo detectado: {archivo_excel['name']} (ID: {archivo_excel['id']})")
+    manifiesto = download_json(service, NOMBRE_MANIFIESTO_INSUMOS, DB_FOLDER_ID)
+    if manifiesto is None:
+        manifiesto = manifiesto_inicial(service, files if lote else listar_excels(service))
 
-    # 3. Descargar el archivo a memoria
+    # 3. Descargar y parsear
     try:
-        excel_bytes = download_file_as_bytes(service, archivo_excel['id'])
+        if lote:
+            pendientes = archivos_pendientes(files, manifiesto)
+            if not pendientes:
+                print("✅ No hay Excel pendientes de procesar.")
+                return reconstruir_sin_insumo(service) if full_rebuild else None
+            print(f"📄 {len(pendientes)} archivos pendientes: {', '.join(f['name'] for f in pendientes)}")
+            insumo = leer_pendientes(pendientes)
+        else:
+            pendientes = files[:1]
+            archivo_excel = files[0]
+            print(f"📄 Archivo detectado: {archivo_excel['name']} (ID: {archivo_excel['id']})")
+            insumo = leer_excel_drive(service, archivo_excel)
         print("✅ Descarga del Excel completada.")
     except Exception as e:
         print(f"❌ Error descargando archivo: {e}")
-        return
+        return None
 
     # 4. Enviar al Procesador (ETL + BigQuery)
     # IMPORTANTE: Pasamos los datos del Excel Y el ID de la carpeta DB para guardar el parquet
     try:
-        procesar_datos(excel_bytes, DB_FOLDER_ID)
-        print("🚀 Ciclo completo finalizado. BigQuery y Drive actualizados.")
+        df_limpio = procesar_datos(insumo, DB_FOLDER_ID, full_rebuild=full_rebuild)
+        upload_json(service, registrar_procesados(manifiesto, pendientes), NOMBRE_MANIFIESTO_INSUMOS, DB_FOLDER_ID)
+        print("✅ Drive y BigQuery actualizados.")
+        return df_limpio
     except Exception as e:
         print(f"❌ Error durante el procesamiento: {e}")
         # Hacemos raise para que GitHub Actions marque error si falla
         raise e
 
+def main(lote=False, full_rebuild=False, publicar_reportes=True, sheets=True):
+    """
+    Pipeline completo en un solo proceso: ingesta -> enriquecimiento -> limpieza ->
+    publicación (Drive, BigQuery, dashboard HTML, Google Sheets). El limpio pasa en
+    memoria de una etapa a la siguiente.
+    """
+    print("🏁 Iniciando proceso de captura...")
+
+    # 1. Autenticación
+    try:
+        service = get_drive_service()
+    except Exception as e:
+        print(f"❌ Error de autenticación: {e}")
+        return
+
+    df_limpio = ingestar(service, lote=lote, full_rebuild=full_rebuild)
+
+    if publicar_reportes:
+        publicar(service, df_limpio, sheets=sheets)
+    print("🚀 Ciclo completo finalizado.")
+
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Ingesta de Excel de 01_insumos, actualización del histórico y publicación.")
+    parser.add_argument('--lote', action='store_true',
+                        help="Procesa todos los Excel pendientes (según el manifiesto) en una sola pasada.")
+    parser.add_argument('--full-rebuild', action='store_true',
+                        help="Re-enriquece todo el histórico (Fase 2/3). Usar cuando cambian reglas o zonas.")
+    parser.add_argument('--sin-publicar', action='store_true',
+                        help="Solo ETL (Drive + BigQuery), sin generar el dashboard ni actualizar Sheets.")
+    parser.add_argument('--sin-sheets', action='store_true',
+                        help="Genera el dashboard HTML pero no actualiza las hojas de Looker.")
+    args = parser.parse_args()
+    main(lote=args.lote, full_rebuild=args.full_rebuild,
+         publicar_reportes=not args.sin_publicar, sheets=not args.sin_sheets)
@@ -1,4 +1,5 @@
-from data_processor import get_drive_service, download_parquet_as_df, upload_to_bigquery
+import argparse
+from data_processor import get_drive_service, descargar_limpio, upload_to_bigquery
 from setup_bigquery_views import create_views
 
 FOLDER_ID_DB = '1q7rGJjb3qCTNcyDUYzpn9v4JveLjsk6t'
@@ -7,7 +8,7 @@ PROJECT_ID = 'autom-bap-personas'
 DATASET_ID = 'tablero_operativo'
 TABLE_ID = 'historico_limpio'
 
-def main():
+def main(modo_carga=None):
     print("🚀 Iniciando restauración de BigQuery desde Drive...")
     
     # 1. Conectar a Drive
@@ -15,7 +16,7 @@ def main():
     
     # 2. Descargar Parquet
     print(f"⬇️ Descargando {FILE_NAME_PARQUET}...")
-    df = download_parquet_as_df(service, FILE_NAME_PARQUET, FOLDER_ID_DB)
+    df = descargar_limpio(service, FOLDER_ID_DB)
     
     if df.empty:
         print("❌ Error: El DataFrame está vacío o no se encontró el archivo.")
@@ -23,11 +24,15 @@ def main():
 
     # 3. Subir a BigQuery
     print(f"Num registros: {len(df)}")
-    upload_to_bigquery(df, PROJECT_ID, DATASET_ID, TABLE_ID)
+    upload_to_bigquery(df, PROJECT_ID, DATASET_ID, TABLE_ID, modo_carga=modo_carga)
     
     # 4. Crear Vistas
     print("\n--- Creando Vistas ---")
     create_views()
 
 if __name__ == "__main__":
-    main()
+    parser = argparse.ArgumentParser(description="Recarga historico_limpio en BigQuery desde el parquet de Drive.")
+    parser.add_argument('--modo-carga', choices=['parquet', 'dataframe'], default=None,
+                        help="parquet: esquema fijo con load_table_from_file (default). dataframe: esquema inferido.")
+    args = parser.parse_args()
+    main(modo_carga=args.modo_carga)
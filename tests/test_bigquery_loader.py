@@ -0,0 +1,117 @@
+import re
+import types
+
+import pandas as pd
+import pytest
+from google.api_core.exceptions import NotFound
+
+import bigquery_loader as L
+
+TABLA = 'p.d.historico_limpio'
+
+# ==========================================
+# CLIENTE FALSO: registra cada operación en orden
+# ==========================================
+
+class _Job:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def result(self):
+        return self.fn()
+
+class ClienteFalso:
+    def __init__(self, tablas=None, falla_carga=False):
+        self.tablas = dict(tablas or {})
+        self.falla_carga = falla_carga
+        self.ops = []
+        self.configs = {}
+
+    def get_table(self, ref):
+        if ref not in self.tablas:
+            raise NotFound(ref)
+        return self.tablas[ref]
+
+    def delete_table(self, ref, not_found_ok=False):
+        self.ops.append(('delete', ref))
+        self.tablas.pop(ref, None)
+
+    def load_table_from_file(self, fh, ref, job_config=None):
+        def correr():
+            self.ops.append(('load', ref))
+            if self.falla_carga:
+                raise RuntimeError('carga rechazada')
+            self.configs[ref] = job_config
+            self.tablas[ref] = types.SimpleNamespace(time_partitioning=job_config.time_partitioning,
+                                                     clustering_fields=job_config.clustering_fields)
+        return _Job(correr)
+
+    def query(self, sql):
+        def correr():
+            self.ops.append(('query', ' '.join(sql.split())))
+            reemplazo = re.search(r"CREATE OR REPLACE TABLE `([^`]+)`.*FROM `([^`]+)`", sql, re.S)
+            if reemplazo:
+                self.tablas[reemplazo.group(1)] = self.tablas[reemplazo.group(2)]
+        return _Job(correr)
+
+def _df():
+    return pd.DataFrame({
+        'Fecha Inicio': pd.to_datetime(['2025-01-06 10:00', '2025-01-14 11:30', None]),
+        'comuna_calculada': [2.5, 14.5, float('nan')],
+        'id_fila': [1, 2, 3],
+    })
+
+# ==========================================
+# TESTS
+# ==========================================
+
+def test_columnas_tabla_codigo_zona_entero():
+    df = L.agregar_columnas_tabla(_df())
+    assert df[L.COLUMNA_ZONA].dtype == 'Int64'
+    assert df[L.COLUMNA_ZONA].tolist()[:2] == [25, 145]
+    assert df[L.COLUMNA_ZONA].isna().iloc[2]
+    tipos = dict(L.esquema_para(df))
+    assert all(tipos[c] in ('INT64', 'STRING') for c in L.COLUMNAS_CLUSTER)
+
+def test_esquema_tipa_fechas_del_crudo_y_rechaza_columnas_no_declaradas():
+    df = _df().assign(**{'Recurso Arribo': pd.to_datetime(['2025-01-06 10:30', None, None])})
+    assert dict(L.esquema_para(df))['Recurso Arribo'] == 'DATETIME'
+    with pytest.raises(ValueError, match='Columna Nueva'):
+        L.esquema_para(df.assign(**{'Columna Nueva': 'x'}))
+
+def test_carga_completa_pasa_por_staging_y_no_borra_la_final():
+    productiva = types.SimpleNamespace(time_partitioning=None, clustering_fields=None)
+    client = ClienteFalso({TABLA: productiva})
+    L.cargar_historico(client, _df(), TABLA)
+
+    staging = TABLA + L.SUFIJO_STAGING_COMPLETO
+    assert [op[0] for op in client.ops] == ['delete', 'load', 'query', 'delete']
+    assert all(ref == staging for op, ref in client.ops if op in ('delete', 'load'))
+    assert client.ops[2][1].startswith(f"CREATE OR REPLACE TABLE `{TABLA}` PARTITION BY Semana_Inicio CLUSTER BY codigo_zona")
+
+    config = client.configs[staging]
+    assert config.write_disposition == 'WRITE_TRUNCATE'
+    assert config.time_partitioning.field == L.COLUMNA_PARTICION
+    assert config.clustering_fields == L.COLUMNAS_CLUSTER
+    assert {f.name: f.field_type for f in config.schema}[L.COLUMNA_ZONA] == 'INT64'
+
+def test_falla_de_carga_se_propaga_y_la_final_queda_intacta():
+    productiva = types.SimpleNamespace(time_partitioning=None, clustering_fields=None)
+    client = ClienteFalso({TABLA: productiva}, falla_carga=True)
+    with pytest.raises(RuntimeError):
+        L.cargar_historico(client, _df(), TABLA)
+    assert client.tablas[TABLA] is productiva
+    assert ('delete', TABLA) not in client.ops
+    assert not any(op == 'query' for op, _ in client.ops)
+
+def test_incremental_mergea_desde_staging():
+    client = ClienteFalso()
+    L.cargar_historico(client, _df(), TABLA)
+    client.ops.clear()
+    L.cargar_historico(client, _df(), TABLA, semana_desde='2025-01-13')
+
+    staging = TABLA + L.SUFIJO_STAGING
+    assert [op[0] for op in client.ops] == ['delete', 'load', 'query', 'delete']
+    assert client.ops[1] == ('load', staging)
+    assert client.ops[2][1].startswith(f"MERGE `{TABLA}` T USING `{staging}` S")
+    assert ('delete', TABLA) not in client.ops
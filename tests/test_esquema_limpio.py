@@ -0,0 +1,19 @@
+import pandas as pd
+
+from bigquery_loader import ESQUEMA_HISTORICO
+from esquema_limpio import ESQUEMA_LIMPIO, aplicar_esquema, columnas_no_declaradas
+
+def test_todas_las_columnas_del_limpio_tienen_tipo_en_bigquery():
+    assert set(ESQUEMA_LIMPIO) <= set(dict(ESQUEMA_HISTORICO))
+
+def test_fechas_de_recurso_se_castean_y_las_no_declaradas_se_informan(capsys):
+    df = pd.DataFrame({
+        'Recurso Arribo': pd.to_datetime(['2025-01-06 10:30', None]).astype('datetime64[ns]'),
+        'Estado': ['CERRADO', 'PENDIENTE'],
+        'Columna Nueva': ['a', 'b'],
+    })
+    salida = aplicar_esquema(df)
+    assert salida['Recurso Arribo'].dtype == 'datetime64[us]'
+    assert salida['Estado'].dtype == 'category'
+    assert columnas_no_declaradas(df) == ['Columna Nueva']
+    assert 'Columna Nueva' in capsys.readouterr().out
@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+
+import data_processor as dp
+
+def _insumo():
+    return pd.DataFrame({
+        'Fecha Inicio': pd.to_datetime(['2025-01-06 10:00:00', '2025-01-07 08:15:30', None]),
+        'Tipo Carta': ['AUTOMATICA', 'MANUAL', 'MANUAL'],
+        'Latitud': [-34.6012, -34.5501, -34.6100],
+        'Longitud': [-58.3811, -58.4102, -58.4000],
+        'Persona DNI': [30123456.0, np.nan, 28999111.0],
+        'Estado': ['CERRADO', None, 'PENDIENTE'],
+    })
+
+def _hash(df):
+    return dp.calcular_hash_contenido(df).tolist()
+
+def test_hash_no_cambia_si_solo_cambia_el_dtype_de_una_columna():
+    base = _insumo()
+    for dni in (base['Persona DNI'].astype('Int64'),
+                pd.Series(['30123456', None, '28999111'], dtype=object),
+                pd.Series([30123456, None, 28999111], dtype=object)):
+        assert _hash(base.assign(**{'Persona DNI': dni})) == _hash(base)
+
+def test_hash_no_depende_de_faltantes_resolucion_ni_columnas():
+    base = _insumo()
+    otra = base.assign(**{
+        'Fecha Inicio': base['Fecha Inicio'].astype('datetime64[s]'),
+        'Estado': pd.Series(['CERRADO', np.nan, 'PENDIENTE'], dtype='str'),
+        'Observaciones': [None, np.nan, pd.NaT],
+    })[list(reversed(base.columns)) + ['Observaciones']]
+    assert _hash(otra) == _hash(base)
+
+def test_hash_cambia_si_se_edita_un_campo():
+    base = _insumo()
+    editada = base.copy()
+    editada.loc[1, 'Estado'] = 'CERRADO'
+    antes, despues = _hash(base), _hash(editada)
+    assert antes[1] != despues[1]
+    assert antes[0] == despues[0] and antes[2] == despues[2]